@@ -0,0 +1,588 @@
+#!/usr/bin/env python2.7
+
+import os
+import imp
+import sys
+import time
+import zlib
+import types
+import struct
+import random
+import socket
+import shutil
+import urlparse
+import resource
+import argparse
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+import simplejson as json
+from multiprocessing import Process, Pipe
+
+
+def install_plugin_base(config):
+    """
+    Installs a stand-in for the gateway's `plugins.base`, so a plugin can run outside the gateway
+    """
+    def marker(name):
+        def decorator(*args, **kwargs):
+            if len(args) == 1 and callable(args[0]) and len(kwargs) == 0:
+                setattr(args[0], name, {})
+                return args[0]
+
+            def wrapper(method):
+                setattr(method, name, kwargs)
+                return method
+            return wrapper
+        return decorator
+
+    class OMPluginBase(object):
+        def __init__(self, webinterface, logger):
+            self.webinterface = webinterface
+            self.logger = logger
+
+        def read_config(self, default_config=None):
+            result = dict(default_config or {})
+            result.update(config)
+            return result
+
+        def write_config(self, config):
+            pass
+
+    class PluginConfigChecker(object):
+        def __init__(self, description):
+            self.description = description
+
+        def check_config(self, config):
+            pass
+
+    base = types.ModuleType('plugins.base')
+    base.OMPluginBase = OMPluginBase
+    base.PluginConfigChecker = PluginConfigChecker
+    for name in ['om_expose', 'om_metric_receive', 'om_metric_data', 'background_task',
+                 'input_status', 'output_status', 'receive_events']:
+        setattr(base, name, marker(name))
+    plugins = types.ModuleType('plugins')
+    plugins.base = base
+    sys.modules['plugins'] = plugins
+    sys.modules['plugins.base'] = base
+
+    serial_utils = types.ModuleType('serial_utils')
+    serial_utils.CommunicationTimedOutException = type('CommunicationTimedOutException', (Exception,), {})
+    sys.modules['serial_utils'] = serial_utils
+
+
+def run_sink(connection, delay, status):
+    """
+    A local HTTP server accepting line protocol writes and a minimal MQTT broker accepting publishes. It runs
+    in its own process, so its CPU usage doesn't count towards the plugin.
+    """
+    totals = {'requests': 0, 'points': 0, 'bytes': 0, 'wire_bytes': 0, 'topics': {}}
+    latencies = []
+    lock = threading.Lock()
+    precisions = {'s': 1, 'ms': 1000, 'u': 1000000, 'us': 1000000, 'ns': 1000000000}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Answer in a single packet, or delayed ACKs add ~40 ms to every kept-alive request
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            now = time.time()
+            wire_bytes = len(body)
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            precision = precisions.get(query.get('precision', ['ns'])[0], 1000000000)
+            lines = body.splitlines()
+            with lock:
+                totals['requests'] += 1
+                totals['points'] += len(lines)
+                totals['bytes'] += len(body)
+                totals['wire_bytes'] += wire_bytes
+                for line in lines:
+                    timestamp = line.rsplit(' ', 1)[-1]
+                    if timestamp.isdigit():
+                        latencies.append(now - int(timestamp) / float(precision))
+            if delay > 0:
+                time.sleep(delay)
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    class MQTTHandler(SocketServer.StreamRequestHandler):
+        disable_nagle_algorithm = True
+
+        def _read(self, length):
+            data = self.rfile.read(length)
+            if len(data) < length:
+                raise EOFError()
+            return data
+
+        def handle(self):
+            try:
+                while True:
+                    header = ord(self._read(1))
+                    length, multiplier = 0, 1
+                    while True:
+                        byte = ord(self._read(1))
+                        length += (byte & 127) * multiplier
+                        multiplier *= 128
+                        if not byte & 128:
+                            break
+                    body = self._read(length)
+                    packet_type = header >> 4
+                    if packet_type == 1:  # CONNECT
+                        self.wfile.write('\x20\x02\x00\x00')
+                    elif packet_type == 3:  # PUBLISH
+                        qos = (header >> 1) & 3
+                        topic_length = struct.unpack('!H', body[:2])[0]
+                        topic = body[2:2 + topic_length]
+                        payload = body[2 + topic_length + (2 if qos > 0 else 0):]
+                        if qos == 1:
+                            self.wfile.write('\x40\x02' + body[2 + topic_length:4 + topic_length])
+                        elif qos == 2:
+                            self.wfile.write('\x50\x02' + body[2 + topic_length:4 + topic_length])
+                        family = '/'.join(topic.split('/')[:3])
+                        with lock:
+                            counters = totals['topics'].setdefault(family, [0, 0])
+                            counters[0] += 1
+                            counters[1] += len(payload)
+                    elif packet_type == 6:  # PUBREL
+                        self.wfile.write('\x70\x02' + body[:2])
+                    elif packet_type == 8:  # SUBSCRIBE
+                        topics, position = 0, 2
+                        while position < len(body):
+                            position += 2 + struct.unpack('!H', body[position:position + 2])[0] + 1
+                            topics += 1
+                        self.wfile.write(chr(0x90) + chr(2 + topics) + body[:2] + '\x00' * topics)
+                    elif packet_type == 12:  # PINGREQ
+                        self.wfile.write('\xd0\x00')
+                    elif packet_type == 14:  # DISCONNECT
+                        return
+                    self.wfile.flush()
+            except (EOFError, socket.error):
+                pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    class MQTTServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    mqtt_server = MQTTServer(('127.0.0.1', 0), MQTTHandler)
+    for instance in [server, mqtt_server]:
+        thread = threading.Thread(target=instance.serve_forever)
+        thread.daemon = True
+        thread.start()
+    connection.send((server.server_address[1], mqtt_server.server_address[1]))
+    while True:
+        command = connection.recv()
+        with lock:
+            if command == 'totals':
+                connection.send(dict(totals, topics=dict((family, list(counters))
+                                                         for family, counters in totals['topics'].iteritems())))
+            elif command == 'latencies':
+                connection.send(list(latencies))
+            else:
+                break
+    server.shutdown()
+    mqtt_server.shutdown()
+
+
+def synthetic_stream(modules, interval, cycles):
+    """
+    Energy modules reporting at a fixed interval. Timestamps are filled in when a metric is submitted.
+    """
+    counters = [random.randint(0, 1000000) for _ in xrange(modules)]
+    for cycle in xrange(cycles):
+        for module in xrange(modules):
+            power = random.uniform(0, 3500)
+            counters[module] += int(power * interval / 3600)
+            yield cycle * interval, {'source': 'OpenMotics',
+                                     'type': 'energy',
+                                     'timestamp': None,
+                                     'tags': {'device': 'OpenMotics energy ID{0}'.format(module),
+                                              'id': module},
+                                     'values': {'power': power,
+                                                'power_counter': counters[module],
+                                                'voltage': random.uniform(228, 232),
+                                                'current': power / 230.0,
+                                                'frequency': 50.0}}
+
+
+def recorded_stream(filename):
+    """
+    Metrics recorded as one JSON object per line, replayed with their original spacing
+    """
+    start = None
+    with open(filename, 'r') as stream:
+        for line in stream:
+            if line.strip():
+                metric = json.loads(line)
+                if start is None:
+                    start = metric['timestamp']
+                yield metric['timestamp'] - start, metric
+
+
+def percentiles(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return 'n/a'
+    pick = lambda fraction: values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+    return 'p50 {0:.2f} ms, p90 {1:.2f} ms, p99 {2:.2f} ms, max {3:.2f} ms'.format(pick(0.5), pick(0.9), pick(0.99), values[-1] * 1000)
+
+
+def get_rss():
+    with open('/proc/self/statm', 'r') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / 1024.0 / 1024.0
+
+
+class FakeWebinterface(object):
+    """
+    Answers the configuration and status calls of the gateway's webinterface, for an installation of a given size
+    """
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def get_input_configurations(self, token):
+        return json.dumps({'success': True,
+                           'config': [{'id': input_id, 'name': 'Input {0}'.format(input_id), 'module_type': 'I'}
+                                      for input_id in xrange(self.outputs)]})
+
+    def get_output_configurations(self, token):
+        return json.dumps({'success': True,
+                           'config': [{'id': output_id, 'name': 'Output {0}'.format(output_id), 'floor': 0,
+                                       'module_type': 'D' if output_id % 2 else 'O', 'type': output_id % 2}
+                                      for output_id in xrange(self.outputs)]})
+
+    def get_output_status(self, token):
+        return json.dumps({'success': True,
+                           'status': [{'id': output_id, 'status': 0, 'dimmer': 0}
+                                      for output_id in xrange(self.outputs)]})
+
+    def set_output(self, token, output_id, is_on, dimmer, timer):
+        return json.dumps({'success': True})
+
+
+def load_plugin(options, directory):
+    # The plugin runs from a copy, so anything it writes next to itself (e.g. a spool) is thrown away afterwards
+    plugin_directory = os.path.join(directory, os.path.basename(os.path.abspath(options.plugin)))
+    shutil.copytree(options.plugin, plugin_directory)
+    sys.path.insert(0, plugin_directory)
+    # On the gateway, bundled eggs are added from the plugin's installation folder
+    for name in os.listdir(plugin_directory):
+        if name.endswith('.egg'):
+            sys.path.insert(0, os.path.join(plugin_directory, name))
+    module = imp.load_source('benchmarked_plugin', os.path.join(plugin_directory, 'main.py'))
+    plugin_class = [value for value in vars(module).values()
+                    if isinstance(value, type) and issubclass(value, module.OMPluginBase) and value is not module.OMPluginBase][0]
+    logs = []
+    plugin = plugin_class(FakeWebinterface(options.outputs),
+                          (lambda message: sys.stdout.write('{0}\n'.format(message))) if options.verbose else logs.append)
+    return plugin_class, plugin
+
+
+def get_receivers(plugin_class, plugin, decorator):
+    return [getattr(plugin, name) for name in dir(plugin_class)
+            if hasattr(getattr(plugin_class, name), decorator)]
+
+
+def report_resources(cpu_start, rss_start, duration, amount, unit):
+    cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime)
+    print 'CPU:          {0:.2f} s ({1:.1f}% of a core, {2:.1f} us per {3})'.format(cpu, cpu / duration * 100, cpu / max(amount, 1) * 1000000, unit)
+    print 'RSS:          {0:.1f} MiB at start, {1:.1f} MiB at end, {2:.1f} MiB peak'.format(rss_start, get_rss(), cpu_end.ru_maxrss / 1024.0)
+
+
+def benchmark_metrics(options, connection, plugin_class, plugin):
+    receivers = get_receivers(plugin_class, plugin, 'om_metric_receive')
+    if len(receivers) == 0:
+        print 'Plugin {0} does not receive metrics'.format(plugin_class.name)
+        sys.exit(1)
+
+    if options.replay is not None:
+        stream = recorded_stream(options.replay)
+    else:
+        stream = synthetic_stream(options.modules, options.interval, options.cycles)
+
+    print 'Benchmarking {0} {1}'.format(plugin_class.name, plugin_class.version)
+    call_durations = []
+    cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+    rss_start = get_rss()
+    start = time.time()
+    submitted = 0
+    for offset, metric in stream:
+        if options.speed > 0:
+            delay = start + offset / options.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if options.replay is None:
+            metric['timestamp'] = time.time()
+        for receiver in receivers:
+            call_start = time.time()
+            receiver(metric)
+            call_durations.append(time.time() - call_start)
+        submitted += 1
+    submit_duration = time.time() - start
+
+    # Wait until the sink stops receiving
+    points, idle_since = 0, time.time()
+    while time.time() - idle_since < options.drain:
+        time.sleep(0.1)
+        connection.send('totals')
+        totals = connection.recv()
+        if totals['points'] != points:
+            points, idle_since = totals['points'], time.time()
+        if points >= submitted:
+            break
+    duration = time.time() - start
+    connection.send('latencies')
+    latencies = connection.recv()
+
+    print 'Submitted:    {0} metrics in {1:.2f} s ({2:.0f} metrics/s)'.format(submitted, submit_duration, submitted / max(submit_duration, 0.001))
+    print 'Received:     {0} points in {1} requests, {2} bytes on the wire, {3} bytes of line protocol ({4:.0f} points/s)'.format(
+        totals['points'], totals['requests'], totals['wire_bytes'], totals['bytes'], totals['points'] / max(duration, 0.001)
+    )
+    print 'Receive call: {0}'.format(percentiles(call_durations))
+    if options.replay is None:
+        print 'Delivery:     {0}'.format(percentiles(latencies))
+    report_resources(cpu_start, rss_start, duration, submitted, 'metric')
+
+
+def benchmark_outputs(options, connection, plugin_class, plugin):
+    """
+    Output status events, every event switching a few random outputs of an installation of `--outputs` outputs.
+    Whatever the plugin publishes to the local MQTT broker is counted per topic family.
+    """
+    receivers = get_receivers(plugin_class, plugin, 'output_status')
+    if len(receivers) == 0:
+        print 'Plugin {0} does not receive output status'.format(plugin_class.name)
+        sys.exit(1)
+
+    print 'Benchmarking {0} {1}'.format(plugin_class.name, plugin_class.version)
+    on_outputs = {}
+    call_durations = []
+    cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+    rss_start = get_rss()
+    start = time.time()
+    for event in xrange(options.events):
+        if options.rate > 0:
+            delay = start + event / options.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        for _ in xrange(options.changes):
+            output_id = random.randrange(options.outputs)
+            if output_id in on_outputs:
+                del on_outputs[output_id]
+            else:
+                on_outputs[output_id] = random.randint(1, 100)
+        status = on_outputs.items()
+        for receiver in receivers:
+            call_start = time.time()
+            receiver(status)
+            call_durations.append(time.time() - call_start)
+    submit_duration = time.time() - start
+
+    # Wait until the broker stops receiving
+    published, idle_since = {}, time.time()
+    while time.time() - idle_since < options.drain:
+        time.sleep(0.1)
+        connection.send('totals')
+        totals = connection.recv()
+        if totals['topics'] != published:
+            published, idle_since = totals['topics'], time.time()
+    duration = time.time() - start
+
+    print 'Submitted:    {0} events ({1} outputs, {2} changes per event) in {3:.2f} s ({4:.0f} events/s)'.format(
+        options.events, options.outputs, options.changes, submit_duration, options.events / max(submit_duration, 0.001)
+    )
+    print 'Receive call: {0}'.format(percentiles(call_durations))
+    for family, (messages, size) in sorted(published.iteritems()):
+        print 'Published:    {0} messages, {1} payload bytes ({2:.1f} bytes/message) on {3}'.format(
+            messages, size, size / float(messages), family
+        )
+    report_resources(cpu_start, rss_start, duration, options.events, 'event')
+
+
+def benchmark_spool(options, plugin_class, directory):
+    """
+    Spool round trips: every cycle the synthetic metrics are appended, part of the spool is read and committed
+    (every other cycle all of it), and the spool is reopened as after a restart after both steps. Afterwards every
+    entry must have been read back exactly once, in order.
+    """
+    module = sys.modules[plugin_class.__module__]
+    if not hasattr(module, 'Spool'):
+        print 'Plugin {0} has no spool'.format(plugin_class.name)
+        sys.exit(1)
+
+    print 'Benchmarking {0} {1} spool'.format(plugin_class.name, plugin_class.version)
+    spool_directory = os.path.join(directory, 'spool')
+    spool = module.Spool(spool_directory)
+    appended, read, errors = 0, 0, 0
+
+    def read_entries(amount):
+        count, mismatches = 0, 0
+        while count < amount:
+            entries, position = spool.peek(min(100, amount - count))
+            if len(entries) == 0:
+                break
+            for entry in entries:
+                if entry != 'benchmark value={0}i'.format(read + count):
+                    mismatches += 1
+                count += 1
+            spool.commit(position)
+        return count, mismatches
+
+    cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+    rss_start = get_rss()
+    start = time.time()
+    for cycle in xrange(options.cycles):
+        spool.append(['benchmark value={0}i'.format(appended + index) for index in xrange(options.modules)])
+        appended += options.modules
+        spool = module.Spool(spool_directory)
+        amount = appended - read if cycle % 2 == 1 else random.randint(0, appended - read)
+        count, mismatches = read_entries(amount)
+        read, errors = read + count, errors + mismatches
+        spool = module.Spool(spool_directory)
+    count, mismatches = read_entries(appended - read)
+    read, errors = read + count, errors + mismatches
+    duration = time.time() - start
+
+    print 'Round trips:  {0} entries in {1} restarts, {2:.2f} s ({3:.0f} entries/s)'.format(appended, options.cycles * 2, duration, appended / max(duration, 0.001))
+    print 'Read back:    {0} entries, {1} lost, {2} out of order'.format(read, appended - read, errors)
+    report_resources(cpu_start, rss_start, duration, appended, 'entry')
+    if read != appended or errors > 0:
+        sys.exit(1)
+
+
+def legacy_encode(metric):
+    """
+    The line protocol encoding of InfluxDB 2.0.63 and before, as a baseline for the encoder
+    """
+    values = metric['values']
+    _values = {}
+    for key in values.keys()[:]:
+        value = values[key]
+        if isinstance(value, basestring):
+            value = '"{0}"'.format(value)
+        if isinstance(value, bool):
+            value = str(value)
+        if isinstance(value, int):
+            value = '{0}i'.format(value)
+        _values[key] = value
+    tags = {'source': metric['source'].lower()}
+    for tag, tvalue in metric['tags'].iteritems():
+        if isinstance(tvalue, basestring):
+            tags[tag] = tvalue.replace(' ', '\\ ').replace(',', '\\,')
+        else:
+            tags[tag] = tvalue
+    return '{0},{1} {2}{3}'.format(metric['type'],
+                                   ','.join('{0}={1}'.format(tname, tvalue) for tname, tvalue in tags.iteritems()),
+                                   ','.join('{0}={1}'.format(vname, vvalue) for vname, vvalue in _values.iteritems()),
+                                   ' {:.0f}'.format(metric['timestamp'] * 1000000000))
+
+
+def benchmark_encoder(options, plugin_class):
+    """
+    Encodes the synthetic (or recorded) metrics with the plugin's line protocol encoder, and with the original
+    encoding as a baseline. Only the encoding is measured, not the queueing and sending.
+    """
+    module = sys.modules[plugin_class.__module__]
+    if not hasattr(module, 'LineProtocolEncoder'):
+        print 'Plugin {0} has no line protocol encoder'.format(plugin_class.name)
+        sys.exit(1)
+
+    if options.replay is not None:
+        metrics = [metric for _, metric in recorded_stream(options.replay)]
+    else:
+        metrics = [metric for _, metric in synthetic_stream(options.modules, options.interval, options.cycles)]
+        for metric in metrics:
+            metric['timestamp'] = time.time()
+
+    print 'Benchmarking {0} {1} encoder'.format(plugin_class.name, plugin_class.version)
+    encoder = module.LineProtocolEncoder()
+    results = []
+    for name, encode in [('Original', legacy_encode), ('Encoder', encoder.encode)]:
+        best, size = None, 0
+        for _ in xrange(3):
+            start = time.time()
+            entries = [encode(metric) for metric in metrics]
+            duration = time.time() - start
+            best = duration if best is None else min(best, duration)
+            size = sum(len(entry) for entry in entries if entry is not None)
+        results.append(best)
+        print '{0:<13} {1:.2f} us per metric, {2:.0f} metrics/s, {3} bytes'.format(
+            name + ':', best / len(metrics) * 1000000, len(metrics) / max(best, 0.000001), size
+        )
+    print 'Speedup:      {0:.2f}x ({1} metrics, best of 3 runs)'.format(results[0] / max(results[1], 0.000001), len(metrics))
+
+
+def benchmark(options):
+    connection, sink_connection = Pipe()
+    sink = Process(target=run_sink, args=(sink_connection, options.sink_delay / 1000.0, options.sink_status))
+    sink.daemon = True
+    sink.start()
+    port, mqtt_port = connection.recv()
+
+    config = {'url': 'http://127.0.0.1:{0}'.format(port),
+              'database': 'benchmark',
+              'broker_ip': '127.0.0.1',
+              'broker_port': mqtt_port}
+    config.update(json.loads(options.config))
+    install_plugin_base(config)
+
+    directory = tempfile.mkdtemp()
+    plugin = None
+    try:
+        plugin_class, plugin = load_plugin(options, directory)
+        if options.scenario == 'outputs':
+            benchmark_outputs(options, connection, plugin_class, plugin)
+        elif options.scenario == 'encoder':
+            benchmark_encoder(options, plugin_class)
+        elif options.scenario == 'spool':
+            benchmark_spool(options, plugin_class, directory)
+        else:
+            benchmark_metrics(options, connection, plugin_class, plugin)
+        if options.stats and hasattr(plugin, 'get_stats'):
+            print 'Plugin stats: {0}'.format(plugin.get_stats())
+    finally:
+        if hasattr(plugin, '_disconnect'):
+            # Stop reconnecting before the broker goes away
+            plugin._disconnect()
+        connection.send('stop')
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks a plugin receiving metrics or output status (against a local HTTP sink and MQTT broker)')
+    parser.add_argument('plugin', help='The plugin folder, e.g. influxdb')
+    parser.add_argument('--scenario', choices=['metrics', 'outputs', 'encoder', 'spool'], default='metrics', help='What to send to the plugin (default: metrics)')
+    parser.add_argument('--modules', type=int, default=500, help='Synthetic energy modules (default: 500)')
+    parser.add_argument('--interval', type=int, default=10, help='Synthetic reporting interval in seconds (default: 10)')
+    parser.add_argument('--cycles', type=int, default=20, help='Synthetic reporting cycles (default: 20)')
+    parser.add_argument('--replay', help='Replay recorded metrics (one JSON object per line) instead')
+    parser.add_argument('--speed', type=float, default=0, help='Replay speed, 1 is real-time and 0 is as fast as possible (default: 0)')
+    parser.add_argument('--outputs', type=int, default=500, help='Outputs (and inputs) in the installation (default: 500)')
+    parser.add_argument('--events', type=int, default=10000, help='Output status events (default: 10000)')
+    parser.add_argument('--changes', type=int, default=3, help='Outputs switched per output status event (default: 3)')
+    parser.add_argument('--rate', type=float, default=0, help='Output status events per second, 0 is as fast as possible (default: 0)')
+    parser.add_argument('--config', default='{}', help='Plugin config overrides, as JSON')
+    parser.add_argument('--sink-delay', type=int, default=0, help='Sink response delay in milliseconds (default: 0)')
+    parser.add_argument('--sink-status', type=int, default=204, help='Sink response status (default: 204)')
+    parser.add_argument('--drain', type=float, default=5, help='Seconds without new points or messages before the run ends (default: 5)')
+    parser.add_argument('--stats', action='store_true', help='Print the plugin\'s own stats afterwards')
+    parser.add_argument('--verbose', action='store_true', help='Print the plugin\'s logs')
+    try:
+        benchmark(parser.parse_args())
+    except KeyboardInterrupt:
+        print ''
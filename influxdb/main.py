@@ -2,12 +2,21 @@
 An InfluxDB plugin, for sending statistics to InfluxDB
 """
 
+import os
+import re
 import time
+import zlib
+import random
+import urllib
+import shutil
+import hashlib
+from bisect import bisect_left
+from fnmatch import fnmatchcase
 import requests
 import simplejson as json
-from threading import Thread
-from collections import deque
-from plugins.base import om_expose, OMPluginBase, PluginConfigChecker, om_metric_receive
+from threading import Thread, Condition, Lock, Event
+from collections import deque, OrderedDict
+from plugins.base import om_expose, OMPluginBase, PluginConfigChecker, om_metric_receive, om_metric_data
 
 
 class InfluxDB(OMPluginBase):
@@ -16,8 +25,9 @@ class InfluxDB(OMPluginBase):
     """
 
     name = 'InfluxDB'
-    version = '2.0.56'
-    interfaces = [('config', '1.0')]
+    version = '2.0.78'
+    interfaces = [('config', '1.0'),
+                  ('metrics', '1.0')]
 
     config_description = [{'name': 'url',
                            'type': 'str',
@@ -30,12 +40,200 @@ class InfluxDB(OMPluginBase):
                            'description': 'Optional password for InfluxDB authentication.'},
                           {'name': 'database',
                            'type': 'str',
-                           'description': 'The InfluxDB database name to witch statistics need to be send.'},
+                           'description': 'The InfluxDB database name to witch statistics need to be send. For InfluxDB 2.x, this is the bucket.'},
+                          {'name': 'api_version',
+                           'type': 'enum',
+                           'choices': ['1.x', '2.x'],
+                           'description': 'The InfluxDB write API to use. InfluxDB 2.x authenticates with the organization and token below. Default: 1.x'},
+                          {'name': 'organization',
+                           'type': 'str',
+                           'description': 'The InfluxDB 2.x organization.'},
+                          {'name': 'token',
+                           'type': 'str',
+                           'description': 'The InfluxDB 2.x API token.'},
+                          {'name': 'precision',
+                           'type': 'enum',
+                           'choices': ['ns', 'us', 'ms', 's'],
+                           'description': 'The precision of the timestamps send to InfluxDB, for all destinations. Default: ns'},
                           {'name': 'batch_size',
                            'type': 'int',
-                           'description': 'The maximum batch size of grouped metrics to be send to InfluxDB.'}]
+                           'description': 'The maximum batch size of grouped metrics to be send to InfluxDB.'},
+                          {'name': 'destinations',
+                           'type': 'section',
+                           'description': 'Additional InfluxDB instances to which the same metrics are send. The batch size falls back to the one above.',
+                           'repeat': True,
+                           'min': 0,
+                           'content': [{'name': 'url', 'type': 'str'},
+                                       {'name': 'database', 'type': 'str'},
+                                       {'name': 'username', 'type': 'str'},
+                                       {'name': 'password', 'type': 'str'},
+                                       {'name': 'batch_size', 'type': 'int'},
+                                       {'name': 'api_version', 'type': 'enum', 'choices': ['1.x', '2.x']},
+                                       {'name': 'organization', 'type': 'str'},
+                                       {'name': 'token', 'type': 'str'}]},
+                          {'name': 'max_linger',
+                           'type': 'int',
+                           'description': 'The maximum time (in milliseconds) metrics are held back to fill up a batch. Default: 500'},
+                          {'name': 'pool_size',
+                           'type': 'int',
+                           'description': 'The maximum amount of kept-alive HTTP connections to InfluxDB. Default: 2'},
+                          {'name': 'timeout',
+                           'type': 'int',
+                           'description': 'The timeout (in seconds) for connecting to and receiving from InfluxDB. Default: 10'},
+                          {'name': 'senders',
+                           'type': 'int',
+                           'description': 'The amount of batches (1-8) that can be send to InfluxDB in parallel. Default: 1'},
+                          {'name': 'queue_max_points',
+                           'type': 'int',
+                           'description': 'The maximum amount of metrics kept in memory while waiting to be send. Default: 50000'},
+                          {'name': 'queue_max_kbytes',
+                           'type': 'int',
+                           'description': 'The maximum memory (in KiB) used by metrics waiting to be send. Default: 8192'},
+                          {'name': 'queue_policy',
+                           'type': 'enum',
+                           'choices': ['drop_oldest', 'drop_newest', 'spill_to_disk'],
+                           'description': 'What to do with new metrics when the queue is full. Default: drop_oldest'},
+                          {'name': 'spool_max_mbytes',
+                           'type': 'int',
+                           'description': 'The maximum disk space (in MiB) used for metrics that could not be send yet. Default: 64'},
+                          {'name': 'replay_rate',
+                           'type': 'int',
+                           'description': 'The maximum amount of metrics per second replayed from disk once InfluxDB is reachable again. Default: 500'},
+                          {'name': 'max_backoff',
+                           'type': 'int',
+                           'description': 'The maximum time (in seconds) between retries while InfluxDB is failing. Default: 300'},
+                          {'name': 'gzip_level',
+                           'type': 'int',
+                           'description': 'The gzip compression level (1-9) of the data send to InfluxDB, 0 to disable. Default: 0'},
+                          {'name': 'query_cache_ttl',
+                           'type': 'int',
+                           'description': 'The time (in seconds) query results are served from memory, 0 to disable. Default: 10'},
+                          {'name': 'query_cache_size',
+                           'type': 'int',
+                           'description': 'The maximum amount of query results kept in memory. Default: 64'},
+                          {'name': 'filters',
+                           'type': 'section',
+                           'description': 'Rules to include or exclude metrics. The first matching rule applies, metrics matching no rule are included. '
+                                          'Empty fields match everything, wildcards (*) are allowed and a tag is matched as name=value.',
+                           'repeat': True,
+                           'min': 0,
+                           'content': [{'name': 'action', 'type': 'enum', 'choices': ['include', 'exclude']},
+                                       {'name': 'source', 'type': 'str'},
+                                       {'name': 'type', 'type': 'str'},
+                                       {'name': 'tag', 'type': 'str'}]},
+                          {'name': 'renames',
+                           'type': 'section',
+                           'description': 'Renames a field of metrics with a given type (empty for all types).',
+                           'repeat': True,
+                           'min': 0,
+                           'content': [{'name': 'type', 'type': 'str'},
+                                       {'name': 'field', 'type': 'str'},
+                                       {'name': 'new_name', 'type': 'str'}]},
+                          {'name': 'aggregations',
+                           'type': 'section',
+                           'description': 'Aggregates the metrics of a series over a window (in seconds) before they are send. '
+                                          'Source and type are matched as with filters.',
+                           'repeat': True,
+                           'min': 0,
+                           'content': [{'name': 'source', 'type': 'str'},
+                                       {'name': 'type', 'type': 'str'},
+                                       {'name': 'window', 'type': 'int'},
+                                       {'name': 'function', 'type': 'enum', 'choices': ['mean', 'min', 'max', 'last']}]},
+                          {'name': 'deduplicate',
+                           'type': 'bool',
+                           'description': 'Skip metrics of which all values are the same as the last send metric of that series.'},
+                          {'name': 'heartbeat',
+                           'type': 'int',
+                           'description': 'The maximum time (in seconds) a deduplicated series stays silent. Default: 300'}]
+
+    counters = ['received', 'written', 'batches', 'bytes', 'sent_bytes', 'dropped', 'spilled', 'replayed', 'rejected',
+                'errors_connection', 'errors_timeout', 'errors_server', 'errors_throttled', 'errors_rejected',
+                'errors_refused']
+
+    metric_definitions = [{'type': 'influxdb',
+                           'tags': ['name', 'destination'],
+                           'metrics': [{'name': 'received',
+                                        'description': 'Metrics queued for the destination',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'written',
+                                        'description': 'Metrics written',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'batches',
+                                        'description': 'Batches written',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'bytes',
+                                        'description': 'Bytes of line protocol send',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'sent_bytes',
+                                        'description': 'Bytes send on the wire',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'dropped',
+                                        'description': 'Metrics dropped by a full queue',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'spilled',
+                                        'description': 'Metrics spilled to disk by a full queue',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'replayed',
+                                        'description': 'Metrics replayed from disk',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'rejected',
+                                        'description': 'Metrics rejected by InfluxDB',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'errors_connection',
+                                        'description': 'Connection errors',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'errors_timeout',
+                                        'description': 'Timeouts',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'errors_server',
+                                        'description': 'Server errors (5xx)',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'errors_throttled',
+                                        'description': 'Throttled requests (429)',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'errors_rejected',
+                                        'description': 'Rejected requests (400, 413, 422)',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'errors_refused',
+                                        'description': 'Refused requests (other 4xx, e.g. bad credentials or missing database)',
+                                        'type': 'counter', 'unit': ''},
+                                       {'name': 'queue_depth',
+                                        'description': 'Metrics waiting in memory',
+                                        'type': 'gauge', 'unit': ''},
+                                       {'name': 'spooled',
+                                        'description': 'Metrics waiting on disk',
+                                        'type': 'gauge', 'unit': ''},
+                                       {'name': 'latency_avg',
+                                        'description': 'Average write latency',
+                                        'type': 'gauge', 'unit': 'ms'},
+                                       {'name': 'latency_p99',
+                                        'description': '99th percentile write latency',
+                                        'type': 'gauge', 'unit': 'ms'}]}]
 
-    default_config = {'url': '', 'database': 'openmotics'}
+    default_config = {'url': '',
+                      'database': 'openmotics',
+                      'api_version': '1.x',
+                      'precision': 'ns',
+                      'batch_size': 10,
+                      'destinations': [],
+                      'max_linger': 500,
+                      'pool_size': 2,
+                      'timeout': 10,
+                      'senders': 1,
+                      'queue_max_points': 50000,
+                      'queue_max_kbytes': 8192,
+                      'queue_policy': 'drop_oldest',
+                      'spool_max_mbytes': 64,
+                      'replay_rate': 500,
+                      'max_backoff': 300,
+                      'gzip_level': 0,
+                      'query_cache_ttl': 10,
+                      'query_cache_size': 64,
+                      'filters': [],
+                      'renames': [],
+                      'aggregations': [],
+                      'deduplicate': False,
+                      'heartbeat': 300}
 
     def __init__(self, webinterface, logger):
         super(InfluxDB, self).__init__(webinterface, logger)
@@ -43,16 +241,11 @@ class InfluxDB(OMPluginBase):
 
         self._config = self.read_config(InfluxDB.default_config)
         self._config_checker = PluginConfigChecker(InfluxDB.config_description)
-        self._pending_metrics = {}
-        self._send_queue = deque()
-        self._batch_sizes = []
-        self._queue_sizes = []
-        self._stats_time = 0
-
-        self._send_thread = Thread(target=self._sender)
-        self._send_thread.setName('InfluxDB batch sender')
-        self._send_thread.daemon = True
-        self._send_thread.start()
+        self._encoder = LineProtocolEncoder()
+        self._destinations = []
+        self._destinations_lock = Lock()
+        self._query_cache = QueryCache()
+        self._query_session = requests.Session()
 
         self._read_config()
         self.logger("Started InfluxDB plugin")
@@ -60,22 +253,67 @@ class InfluxDB(OMPluginBase):
     def _read_config(self):
         self._url = self._config['url']
         self._database = self._config['database']
-        self._batch_size = self._config.get('batch_size', 10)
-        username = self._config.get('username', '')
-        password = self._config.get('password', '')
-        self._auth = None if username == '' else (username, password)
+        defaults = InfluxDB.default_config
+        self._precision = LineProtocolEncoder.PRECISIONS.get(self._config.get('precision', defaults['precision']), 1000000000)
+        heartbeat = max(1, self._config.get('heartbeat', defaults['heartbeat']))
+        self._pipeline = MetricPipeline(self._config.get('filters', defaults['filters']),
+                                        self._config.get('renames', defaults['renames']),
+                                        self._config.get('aggregations', defaults['aggregations']),
+                                        heartbeat if self._config.get('deduplicate', defaults['deduplicate']) else None)
 
-        self._endpoint = '{0}/write?db={1}'.format(self._url, self._database)
         self._query_endpoint = '{0}/query?db={1}&epoch=ns'.format(self._url, self._database)
-        self._headers = {'X-Requested-With': 'OpenMotics plugin: InfluxDB'}
+        self._query_session.auth = None
+        self._query_session.headers.update({'X-Requested-With': 'OpenMotics plugin: InfluxDB'})
+        self._query_session.headers.pop('Authorization', None)
+        self._query_session.verify = False
+        if self._config.get('api_version') == '2.x' and self._config.get('token'):
+            # InfluxQL is served by the 1.x compatible endpoint, which accepts the 2.x token as well
+            self._query_session.headers['Authorization'] = 'Token {0}'.format(self._config['token'])
+        elif self._config.get('username'):
+            self._query_session.auth = (self._config['username'], self._config.get('password', ''))
+        self._query_cache.configure(self._config.get('query_cache_ttl', defaults['query_cache_ttl']),
+                                    self._config.get('query_cache_size', defaults['query_cache_size']))
+
+        destination_configs = [{'url': self._url,
+                                'database': self._database,
+                                'username': self._config.get('username', ''),
+                                'password': self._config.get('password', ''),
+                                'api_version': self._config.get('api_version', defaults['api_version']),
+                                'organization': self._config.get('organization', ''),
+                                'token': self._config.get('token', '')}] + self._config.get('destinations', defaults['destinations'])
+        plugin_directory = os.path.dirname(os.path.abspath(__file__))
+        with self._destinations_lock:
+            current = dict(((destination.url, destination.database), destination) for destination in self._destinations)
+            destinations = []
+            configured = set()
+            for destination_config in destination_configs:
+                url = destination_config.get('url', '')
+                database = destination_config.get('database', '')
+                if url == '' or database == '':
+                    continue
+                if (url, database) in configured:
+                    # A second destination would share the spool, and write every metric twice
+                    self.logger('Skipping destination {0}/{1}, it is configured already'.format(url, database))
+                    continue
+                configured.add((url, database))
+                destination = current.pop((url, database), None)
+                if destination is None:
+                    # Every destination has its own spool, so spooled metrics never end up in another InfluxDB
+                    spool_name = hashlib.md5('{0}/{1}'.format(url, database)).hexdigest()[:12]
+                    destination = Destination(url, database, os.path.join(plugin_directory, 'spool', spool_name), self.logger)
+                destination.configure(destination_config, self._config)
+                destinations.append(destination)
+            for destination in current.itervalues():
+                destination.stop()
+            self._destinations = destinations
 
-        self._enabled = self._url != '' and self._database != ''
+        self._enabled = len(self._destinations) > 0
         self.logger('InfluxDB is {0}'.format('enabled' if self._enabled else 'disabled'))
 
     @om_metric_receive(interval=10)
     def _receive_metric_data(self, metric):
         """
-        All metrics are collected, as filtering is done more finegraded when mapping to tables
+        All metrics are collected, and passed through the configured filters, renames and aggregations
         > example_metric = {"source": "OpenMotics",
         >                   "type": "energy",
         >                   "timestamp": 1497677091,
@@ -88,82 +326,59 @@ class InfluxDB(OMPluginBase):
             if self._enabled is False:
                 return
 
-            values = metric['values']
-            _values = {}
-            for key in values.keys()[:]:
-                value = values[key]
-                if isinstance(value, basestring):
-                    value = '"{0}"'.format(value)
-                if isinstance(value, bool):
-                    value = str(value)
-                if isinstance(value, int):
-                    value = '{0}i'.format(value)
-                _values[key] = value
+            destinations = self._destinations
+            precision = self._precision
+            for processed_metric in self._pipeline.process(metric):
+                # Encoded once, and shared by all destinations
+                entry = self._encoder.encode(processed_metric, precision)
+                if entry is not None:
+                    for destination in destinations:
+                        destination.enqueue(entry, precision)
+        except Exception as ex:
+            self.logger('Error receiving metrics: {0}'.format(ex))
 
-            tags = {'source': metric['source'].lower()}
-            for tag, tvalue in metric['tags'].iteritems():
-                if isinstance(tvalue, basestring):
-                    tags[tag] = tvalue.replace(' ', '\ ').replace(',', '\,')
-                else:
-                    tags[tag] = tvalue
-
-            entry = self._build_entry(metric['type'], tags, _values, metric['timestamp'] * 1000000000)
-            self._send_queue.appendleft(entry)
+    @om_metric_data(interval=60)
+    def collect_metrics(self):
+        now = time.time()
+        for destination in self._destinations:
+            yield {'type': 'influxdb',
+                   'timestamp': now,
+                   'tags': {'name': 'InfluxDB',
+                            'destination': destination.name},
+                   'values': destination.get_values()}
 
+    @om_expose
+    def query(self, query):
+        """
+        Runs an InfluxQL query against the primary InfluxDB. Dashboards repeat the same queries every few seconds,
+        so results are cached for `query_cache_ttl` seconds.
+        """
+        if self._url == '' or self._database == '':
+            return json.dumps({'success': False, 'msg': 'InfluxDB is not configured'})
+        key = QueryCache.normalize(query)
+        result = self._query_cache.get(key)
+        if result is not None:
+            return json.dumps({'success': True, 'cached': True, 'result': result})
+        try:
+            response = self._query_session.get(self._query_endpoint,
+                                               params={'q': query},
+                                               timeout=max(1, self._config.get('timeout', InfluxDB.default_config['timeout'])))
+            if response.status_code != 200:
+                return json.dumps({'success': False, 'msg': 'Query failed, received: {0} ({1})'.format(response.text.strip(), response.status_code)})
+            result = response.json()
         except Exception as ex:
-            self.logger('Error receiving metrics: {0}'.format(ex))
+            self.logger('Error querying InfluxDB: {0}'.format(ex))
+            return json.dumps({'success': False, 'msg': str(ex)})
+        if 'error' not in result and all('error' not in statement for statement in result.get('results', [])):
+            self._query_cache.put(key, result)
+        return json.dumps({'success': True, 'cached': False, 'result': result})
 
-    @staticmethod
-    def _build_entry(key, tags, value, timestamp):
-        if isinstance(value, dict):
-                values = ','.join('{0}={1}'.format(vname, vvalue)
-                                  for vname, vvalue in value.iteritems())
-        else:
-            values = 'value={0}'.format(value)
-        return '{0},{1} {2}{3}'.format(key,
-                                       ','.join('{0}={1}'.format(tname, tvalue)
-                                                for tname, tvalue in tags.iteritems()),
-                                       values,
-                                       '' if timestamp is None else ' {:.0f}'.format(timestamp))
-
-    def _sender(self):
-        while True:
-            try:
-                data = []
-                try:
-                    while True:
-                        data.append(self._send_queue.pop())
-                        if len(data) == self._batch_size:
-                            raise IndexError()
-                except IndexError:
-                    pass
-                if len(data) > 0:
-                    self._batch_sizes.append(len(data))
-                    self._queue_sizes.append(len(self._send_queue))
-                    response = requests.post(url=self._endpoint,
-                                             data='\n'.join(data),
-                                             headers=self._headers,
-                                             auth=self._auth,
-                                             verify=False)
-                    if response.status_code != 204:
-                        self.logger('Send failed, received: {0} ({1})'.format(response.text, response.status_code))
-                    if self._stats_time < time.time() - 1800:
-                        self._stats_time = time.time()
-                        self.logger('Queue size stats: {0:.2f} min, {1:.2f} avg, {2:.2f} max'.format(
-                            min(self._queue_sizes),
-                            sum(self._queue_sizes) / float(len(self._queue_sizes)),
-                            max(self._queue_sizes)
-                        ))
-                        self.logger('Batch size stats: {0:.2f} min, {1:.2f} avg, {2:.2f} max'.format(
-                            min(self._batch_sizes),
-                            sum(self._batch_sizes) / float(len(self._batch_sizes)),
-                            max(self._batch_sizes)
-                        ))
-                        self._batch_sizes = []
-                        self._queue_sizes = []
-            except Exception as ex:
-                self.logger('Error sending from queue: {0}'.format(ex))
-            time.sleep(0.1)
+    @om_expose
+    def get_stats(self):
+        return json.dumps({'deduplicated': self._pipeline.deduplicated,
+                           'query_cache': self._query_cache.get_stats(),
+                           'destinations': dict((destination.name, destination.get_stats())
+                                                for destination in self._destinations)})
 
     @om_expose
     def get_config_description(self):
@@ -184,3 +399,940 @@ class InfluxDB(OMPluginBase):
         self._read_config()
         self.write_config(config)
         return json.dumps({'success': True})
+
+
+class Destination(object):
+    """
+    An InfluxDB instance to which metrics are send. Every destination has its own queue, senders and spool, so a
+    slow or unreachable destination never holds back the others.
+    """
+
+    def __init__(self, url, database, spool_directory, logger):
+        self.url = url
+        self.database = database
+        self.name = '{0}/{1}'.format(url, database)
+        self._logger = logger
+        self._stopped = False
+        self._send_queue = deque()
+        self._send_condition = Condition()
+        self._queue_since = None
+        self._queue_bytes = 0
+        self._queue_overflowing = False
+        self._spool = Spool(spool_directory)
+        self._replay_event = Event()
+        self._backoff = 0
+        self._backoff_until = 0
+        self._backoff_lock = Lock()
+        self._stats_time = 0
+        self._stats_lock = Lock()
+        self._counters = dict((counter, 0) for counter in InfluxDB.counters)
+        self._histograms = {'latency': Histogram([5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]),
+                            'batch_size': Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000]),
+                            'queue_depth': Histogram([0, 10, 100, 1000, 10000, 100000])}
+        self._precision = 1000000000
+        self._session = None
+        self._session_key = None
+        self._sessions_created = 0
+        self._sender_count = 0
+        self._send_threads = []
+        self._replay_thread = None
+
+    def logger(self, message):
+        self._logger('[{0}] {1}'.format(self.name, message))
+
+    def configure(self, destination_config, config):
+        """
+        Applies the destination's own settings, and the settings shared by all destinations from the plugin config
+        """
+        defaults = InfluxDB.default_config
+        username = destination_config.get('username', '')
+        token = destination_config.get('token', '')
+        # A batch size of 0 (or less) falls back to the default, as an empty batch would make the senders spin
+        self._batch_size = destination_config.get('batch_size') or config.get('batch_size') or defaults['batch_size']
+        if self._batch_size < 1:
+            self._batch_size = defaults['batch_size']
+        self._max_linger = max(0, config.get('max_linger', defaults['max_linger'])) / 1000.0
+        self._auth = None if not username else (username, destination_config.get('password', ''))
+        self._sender_count = max(1, min(8, config.get('senders', defaults['senders'])))
+        self._pool_size = max(config.get('pool_size', defaults['pool_size']), self._sender_count)
+        self._timeout = max(1, config.get('timeout', defaults['timeout']))
+        # The queue holds at least a batch, so a limit of 0 doesn't drop (nearly) everything
+        self._queue_max_points = max(self._batch_size, config.get('queue_max_points', defaults['queue_max_points']))
+        self._queue_max_bytes = max(1, config.get('queue_max_kbytes', defaults['queue_max_kbytes'])) * 1024
+        self._queue_policy = config.get('queue_policy', defaults['queue_policy'])
+        self._spool.max_bytes = max(1, config.get('spool_max_mbytes', defaults['spool_max_mbytes'])) * 1024 * 1024
+        self._replay_rate = max(1, config.get('replay_rate', defaults['replay_rate']))
+        self._max_backoff = max(1, config.get('max_backoff', defaults['max_backoff']))
+        self._gzip_level = max(0, min(9, config.get('gzip_level', defaults['gzip_level'])))
+
+        precision = config.get('precision', defaults['precision'])
+        self._headers = {'X-Requested-With': 'OpenMotics plugin: InfluxDB'}
+        if destination_config.get('api_version') == '2.x':
+            parameters = [('org', destination_config.get('organization', '')),
+                          ('bucket', self.database),
+                          ('precision', precision)]
+            self._endpoint = '{0}/api/v2/write?{1}'.format(self.url, urllib.urlencode(parameters))
+            if token:
+                self._auth = None
+                self._headers['Authorization'] = 'Token {0}'.format(token)
+        else:
+            # InfluxDB 1.x names microseconds 'u'
+            parameters = [('db', self.database),
+                          ('precision', 'u' if precision == 'us' else precision)]
+            self._endpoint = '{0}/write?{1}'.format(self.url, urllib.urlencode(parameters))
+
+        with self._send_condition:
+            self._set_precision(LineProtocolEncoder.PRECISIONS.get(precision, 1000000000))
+
+        # The auth and headers are baked into the session, so any change (e.g. from a token to basic auth) needs a new one
+        session_key = (self._auth, tuple(sorted(self._headers.iteritems())), self._pool_size)
+        if session_key != self._session_key:
+            old_session = self._session
+            self._session = self._build_session()
+            self._session_key = session_key
+            if old_session is not None:
+                old_session.close()
+
+        with self._send_condition:
+            self._send_threads = [thread for thread in self._send_threads if thread.is_alive()]
+            for index in xrange(len(self._send_threads), self._sender_count):
+                thread = Thread(target=self._sender, args=(index,))
+                thread.setName('InfluxDB batch sender {0}'.format(index))
+                thread.daemon = True
+                thread.start()
+                self._send_threads.append(thread)
+            # Wake up all senders, so they pick up the new settings (or stop when no longer needed)
+            self._send_condition.notify_all()
+
+        if self._replay_thread is None:
+            self._replay_thread = Thread(target=self._replayer)
+            self._replay_thread.setName('InfluxDB spool replayer')
+            self._replay_thread.daemon = True
+            self._replay_thread.start()
+
+    def stop(self):
+        """
+        Stops the senders and the replayer of a destination that is no longer configured. The metrics it still
+        has queued or spooled are discarded, and its spool is removed.
+        """
+        self._stopped = True
+        with self._send_condition:
+            self._sender_count = 0
+            discarded = len(self._send_queue)
+            self._send_queue.clear()
+            self._queue_bytes = 0
+            self._queue_since = None
+            self._send_condition.notify_all()
+        self._replay_event.set()
+        discarded += len(self._spool)
+        try:
+            self._spool.remove()
+        except Exception as ex:
+            self.logger('Error removing the spool: {0}'.format(ex))
+        if self._session is not None:
+            self._session.close()
+        self.logger('Removed, {0} metrics not send yet were discarded'.format(discarded))
+
+    def _build_session(self):
+        """
+        Builds a session that keeps connections alive, so not every batch pays for a new (TLS) connection
+        """
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self._pool_size)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(self._headers)
+        session.auth = self._auth
+        session.verify = False
+        self._sessions_created += 1
+        return session
+
+    def _get_connection_stats(self):
+        connections = 0
+        requests_sent = 0
+        adapter = self._session.get_adapter(self.url)
+        if adapter is not None:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_sent += pool.num_requests
+        return {'sessions': self._sessions_created,
+                'connections': connections,
+                'requests': requests_sent,
+                'reused': max(0, requests_sent - connections)}
+
+    def _set_precision(self, precision):
+        """
+        Converts the queued metrics to a new precision. Must be called while holding the send condition.
+        """
+        if precision == self._precision:
+            return
+        self._send_queue = deque(LineProtocolEncoder.convert_precision(entry, self._precision, precision)
+                                 for entry in self._send_queue)
+        self._queue_bytes = sum(len(entry) for entry in self._send_queue)
+        self._precision = precision
+
+    def _queue_full(self, size):
+        return (len(self._send_queue) >= self._queue_max_points or
+                self._queue_bytes + size > self._queue_max_bytes)
+
+    def enqueue(self, entry, precision):
+        if precision != self._precision:
+            # Encoded just before the precision changed
+            entry = LineProtocolEncoder.convert_precision(entry, precision, self._precision)
+        size = len(entry)
+        self._count('received')
+        with self._send_condition:
+            if self._queue_full(size):
+                if self._queue_overflowing is False:
+                    self._queue_overflowing = True
+                    self.logger('Queue is full ({0} metrics), applying {1} policy'.format(len(self._send_queue), self._queue_policy))
+                if self._queue_policy == 'spill_to_disk':
+                    self._count('spilled')
+                    self._spool_batch([entry])
+                    return
+                if self._queue_policy == 'drop_newest':
+                    self._count('dropped')
+                    return
+                while len(self._send_queue) > 0 and self._queue_full(size):
+                    self._queue_bytes -= len(self._send_queue.pop())
+                    self._count('dropped')
+            self._send_queue.appendleft(entry)
+            self._queue_bytes += size
+            if self._queue_since is None:
+                # The sender needs to know when the linger period started
+                self._queue_since = time.time()
+                self._send_condition.notify()
+            elif len(self._send_queue) >= self._batch_size:
+                self._send_condition.notify()
+
+    def _get_batch(self, index):
+        """
+        Blocks until a full batch is available, or until the oldest queued entry waited for `max_linger`.
+        Returns None when the sender with the given index is no longer needed.
+        """
+        with self._send_condition:
+            while True:
+                if index >= self._sender_count:
+                    return None
+                if self._queue_since is None:
+                    self._send_condition.wait()
+                    continue
+                if len(self._send_queue) >= self._batch_size:
+                    break
+                remaining = self._queue_since + self._max_linger - time.time()
+                if remaining <= 0:
+                    break
+                self._send_condition.wait(remaining)
+            data = []
+            while len(self._send_queue) > 0 and len(data) < self._batch_size:
+                entry = self._send_queue.pop()
+                self._queue_bytes -= len(entry)
+                data.append(entry)
+            if self._queue_overflowing is True and not self._queue_full(0):
+                self._queue_overflowing = False
+            if len(self._send_queue) > 0:
+                self._queue_since = time.time()
+                # Let another sender pick up the remainder while this batch is in flight
+                self._send_condition.notify()
+            else:
+                self._queue_since = None
+            return data
+
+    def _spool_batch(self, data):
+        if self._stopped is True:
+            return  # The destination was removed, together with its spool
+        try:
+            if self._precision != Spool.PRECISION:
+                # The spool always holds nanoseconds, so it survives a change of precision
+                data = [LineProtocolEncoder.convert_precision(entry, self._precision, Spool.PRECISION) for entry in data]
+            self._spool.append(data)
+            self._replay_event.set()
+        except Exception as ex:
+            self.logger('Error writing {0} metrics to the spool: {1}'.format(len(data), ex))
+
+    def _register_failure(self, message, retry_after=None):
+        """
+        Backs off exponentially (with jitter), so a failing InfluxDB isn't hammered with retries
+        """
+        with self._backoff_lock:
+            if self._backoff == 0:
+                self.logger('{0}, backing off'.format(message))
+            self._backoff = min(self._max_backoff, max(1, self._backoff * 2))
+            delay = random.uniform(self._backoff / 2.0, self._backoff)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            self._backoff_until = time.time() + delay
+
+    def _register_success(self):
+        with self._backoff_lock:
+            if self._backoff > 0:
+                self._backoff = 0
+                self._backoff_until = 0
+                self.logger('InfluxDB is reachable again')
+
+    # Statuses caused by the metrics themselves, the others (e.g. bad credentials or a missing database) are
+    # retried like server errors
+    REJECTED_STATUSES = [400, 413, 422]
+
+    def _send(self, data):
+        """
+        Sends a batch to InfluxDB and returns the metrics that should be retried later. A rejected batch is split
+        up to find and drop only the malformed metrics.
+        """
+        payload = '\n'.join(data)
+        headers = None
+        self._count('bytes', len(payload))
+        if self._gzip_level > 0:
+            # Line protocol repeats the tag sets a lot, so it compresses very well
+            compressor = zlib.compressobj(self._gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            payload = compressor.compress(payload) + compressor.flush()
+            headers = {'Content-Encoding': 'gzip'}
+        self._count('sent_bytes', len(payload))
+        start = time.time()
+        try:
+            response = self._session.post(url=self._endpoint,
+                                          data=payload,
+                                          headers=headers,
+                                          timeout=self._timeout)
+        except Exception as ex:
+            # Not only requests' own exceptions (e.g. urllib3's ValueError on a bad setting): the batch is popped
+            # already, so it must be returned to be spooled
+            self._count('errors_timeout' if isinstance(ex, requests.exceptions.Timeout) else 'errors_connection')
+            self._register_failure('Send failed: {0}'.format(ex))
+            return data
+        self._observe('latency', (time.time() - start) * 1000)
+        if response.status_code == 204:
+            self._count('batches')
+            self._count('written', len(data))
+            self._register_success()
+            return []
+        rejected = response.status_code in Destination.REJECTED_STATUSES
+        self._count('errors_throttled' if response.status_code == 429 else
+                    'errors_server' if response.status_code >= 500 else
+                    'errors_rejected' if rejected else
+                    'errors_refused')
+        if not rejected:
+            self._register_failure('Send failed, received: {0} ({1})'.format(response.text, response.status_code),
+                                   retry_after=response.headers.get('Retry-After'))
+            return data
+        if len(data) == 1:
+            self._count('rejected')
+            self.logger('Dropped rejected metric: {0} ({1})'.format(data[0], response.text.strip()))
+            return []
+        middle = len(data) / 2
+        remaining = self._send(data[:middle])
+        if len(remaining) > 0:
+            return remaining + data[middle:]
+        return self._send(data[middle:])
+
+    def _sender(self, index):
+        """
+        Every point carries its own timestamp, so parallel senders don't affect how InfluxDB orders a series
+        """
+        while True:
+            try:
+                data = self._get_batch(index)
+                if data is None:
+                    return
+                if len(data) > 0:
+                    self._observe('batch_size', len(data))
+                    self._observe('queue_depth', len(self._send_queue))
+                    if time.time() < self._backoff_until:
+                        # InfluxDB is failing, park the batch in the spool so the replayer can retry it
+                        self._spool_batch(data)
+                    else:
+                        remaining = self._send(data)
+                        if len(remaining) > 0:
+                            self._spool_batch(remaining)
+                    self.log_stats()
+            except Exception as ex:
+                self.logger('Error sending from queue: {0}'.format(ex))
+                time.sleep(1)
+
+    def _replayer(self):
+        """
+        Replays spooled metrics in order, rate limited so the backfill doesn't starve live metrics
+        """
+        while self._stopped is False:
+            try:
+                if len(self._spool) == 0:
+                    self._replay_event.clear()
+                    if len(self._spool) == 0:
+                        self._replay_event.wait()
+                        continue
+                backoff = self._backoff_until - time.time()
+                if backoff > 0:
+                    time.sleep(backoff)
+                    continue
+                start = time.time()
+                data, position = self._spool.peek(self._batch_size)
+                if len(data) == 0:
+                    time.sleep(1)
+                    continue
+                if self._precision != Spool.PRECISION:
+                    data = [LineProtocolEncoder.convert_precision(entry, Spool.PRECISION, self._precision) for entry in data]
+                remaining = self._send(data)
+                if len(remaining) < len(data):
+                    self._spool.commit(position)
+                    self._count('replayed', len(data) - len(remaining))
+                    if len(remaining) > 0:
+                        self._spool_batch(remaining)
+                delay = len(data) / float(self._replay_rate) - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            except Exception as ex:
+                self.logger('Error replaying from spool: {0}'.format(ex))
+                time.sleep(10)
+
+    def _count(self, counter, amount=1):
+        with self._stats_lock:
+            self._counters[counter] += amount
+
+    def _observe(self, histogram, value):
+        with self._stats_lock:
+            self._histograms[histogram].add(value)
+
+    def log_stats(self):
+        with self._stats_lock:
+            if self._stats_time < time.time() - 1800:
+                self._stats_time = time.time()
+                for name, title in [('queue_depth', 'Queue size'), ('batch_size', 'Batch size'), ('latency', 'Latency (ms)')]:
+                    histogram = self._histograms[name]
+                    if histogram.count > 0:
+                        self.logger('{0} stats: {1[min]:.2f} min, {1[avg]:.2f} avg, {1[p99]:.2f} p99, {1[max]:.2f} max'.format(
+                            title, histogram.as_dict()
+                        ))
+                    histogram.reset()
+                self.logger('Connection stats: {0[requests]} requests over {0[connections]} connections'.format(
+                    self._get_connection_stats()
+                ))
+                self.logger('Write stats: {0[written]} written, {0[rejected]} rejected, {0[dropped]} dropped, {0[spilled]} spilled to disk'.format(
+                    self._counters
+                ))
+                self.logger('Spool stats: {0[spooled]} metrics on disk ({0[spool_bytes]} bytes), {1[replayed]} replayed, {0[spool_dropped]} dropped'.format(
+                    self._get_queue_stats(), self._counters
+                ))
+
+    def _get_queue_stats(self):
+        return {'points': len(self._send_queue),
+                'bytes': self._queue_bytes,
+                'spooled': len(self._spool),
+                'spool_bytes': self._spool.size,
+                'spool_dropped': self._spool.dropped,
+                'backoff': max(0, self._backoff_until - time.time())}
+
+    def get_values(self):
+        """
+        Returns the counters and gauges of this destination as metric values
+        """
+        with self._stats_lock:
+            # Floats only, so the field types don't depend on the size of the counters
+            values = dict((counter, float(value)) for counter, value in self._counters.iteritems())
+            latency = self._histograms['latency'].as_dict()
+        values.update({'queue_depth': float(len(self._send_queue)),
+                       'spooled': float(len(self._spool)),
+                       'latency_avg': float(latency['avg']),
+                       'latency_p99': float(latency['p99'])})
+        return values
+
+    def get_stats(self):
+        """
+        Counters are totals since the destination was created, histograms cover the period since the last stats log
+        """
+        with self._stats_lock:
+            counters = dict(self._counters)
+            histograms = dict((name, histogram.as_dict()) for name, histogram in self._histograms.iteritems())
+        return {'counters': counters,
+                'histograms': histograms,
+                'queue': self._get_queue_stats(),
+                'connections': self._get_connection_stats()}
+
+
+class Histogram(object):
+    """
+    A constant memory histogram with fixed bucket bounds. Percentiles are estimated as the upper bound of the
+    bucket they fall in.
+    """
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self._buckets = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        self._buckets[bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def percentile(self, percentile):
+        if self.count == 0:
+            return 0
+        rank = percentile / 100.0 * self.count
+        seen = 0
+        for index, amount in enumerate(self._buckets):
+            seen += amount
+            if seen >= rank:
+                if index == len(self._bounds):
+                    return self.maximum
+                return min(self._bounds[index], self.maximum)
+        return self.maximum
+
+    def as_dict(self):
+        if self.count == 0:
+            return {'count': 0, 'min': 0, 'max': 0, 'avg': 0, 'p50': 0, 'p90': 0, 'p99': 0}
+        return {'count': self.count,
+                'min': self.minimum,
+                'max': self.maximum,
+                'avg': self.total / float(self.count),
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+
+class MetricPipeline(object):
+    """
+    Filters, renames, aggregates and deduplicates metrics before they are encoded
+    """
+
+    def __init__(self, filters, renames, aggregations, heartbeat=None):
+        self._filters = [(rule.get('action', 'include') == 'include',
+                          rule.get('source') or '*',
+                          rule.get('type') or '*',
+                          MetricPipeline._parse_tag(rule.get('tag')))
+                         for rule in filters]
+        self._renames = {}
+        for rule in renames:
+            if rule.get('field') and rule.get('new_name'):
+                self._renames.setdefault(rule.get('type') or '*', {})[rule['field']] = rule['new_name']
+        self._aggregations = [(rule.get('source') or '*',
+                               rule.get('type') or '*',
+                               rule['window'],
+                               rule.get('function', 'mean'))
+                              for rule in aggregations if rule.get('window', 0) > 0]
+        self._windows = {}
+        self._cache = {}
+        self._heartbeat = heartbeat
+        self._last_sent = {}
+        self.deduplicated = 0
+
+    @staticmethod
+    def _parse_tag(tag):
+        if not tag:
+            return None
+        name, _, pattern = tag.partition('=')
+        return name, pattern or '*'
+
+    def _match_filters(self, metric):
+        for include, source, metric_type, tag in self._filters:
+            if not fnmatchcase(metric['source'], source) or not fnmatchcase(metric['type'], metric_type):
+                continue
+            if tag is not None:
+                value = metric['tags'].get(tag[0])
+                if value is None or not fnmatchcase(LineProtocolEncoder._to_str(value), tag[1]):
+                    continue
+            return include
+        return True
+
+    def _get_rules(self, metric):
+        """
+        Filter and aggregation rules only depend on the source, type and tags, so they're cached per series
+        """
+        cache_key = (metric['source'], metric['type'], frozenset(metric['tags'].iteritems()))
+        rules = self._cache.get(cache_key)
+        if rules is None:
+            aggregation = None
+            for source, metric_type, window, function in self._aggregations:
+                if fnmatchcase(metric['source'], source) and fnmatchcase(metric['type'], metric_type):
+                    aggregation = (window, function)
+                    break
+            renames = dict(self._renames.get('*', {}))
+            renames.update(self._renames.get(metric['type'], {}))
+            rules = (self._match_filters(metric), renames, aggregation)
+            if len(self._cache) >= 4096:
+                self._cache = {}
+            self._cache[cache_key] = rules
+        return cache_key, rules
+
+    def process(self, metric):
+        """
+        Returns the metrics to be send for a received metric
+        """
+        if len(self._filters) == 0 and len(self._renames) == 0 and len(self._aggregations) == 0 and self._heartbeat is None:
+            return [metric]
+        cache_key, (included, renames, aggregation) = self._get_rules(metric)
+        if included is False:
+            return []
+        if len(renames) > 0:
+            metric = dict(metric)
+            metric['values'] = dict((renames.get(key, key), value) for key, value in metric['values'].iteritems())
+        metrics = [metric] if aggregation is None else self._aggregate(cache_key, metric, *aggregation)
+        if self._heartbeat is None:
+            return metrics
+        return [entry for entry in metrics if self._changed(cache_key, entry)]
+
+    def _changed(self, series, metric):
+        """
+        Checks whether a metric differs from the last one send for its series, or whether the heartbeat is due
+        """
+        last = self._last_sent.get(series)
+        if last is not None and last[1] == metric['values'] and metric['timestamp'] - last[0] < self._heartbeat:
+            self.deduplicated += 1
+            return False
+        self._last_sent[series] = (metric['timestamp'], metric['values'])
+        return True
+
+    def _aggregate(self, series, metric, window, function):
+        """
+        Collects the values of a series per window. A window is emitted when the first metric of a next window
+        arrives, with the window's start as timestamp.
+        """
+        start = int(metric['timestamp']) - int(metric['timestamp']) % window
+        current = self._windows.get(series)
+        emitted = []
+        if current is not None and current['start'] != start:
+            emitted.append(MetricPipeline._emit(current, function))
+            current = None
+        if current is None:
+            current = {'start': start, 'metric': metric, 'values': {}}
+            self._windows[series] = current
+        for key, value in metric['values'].iteritems():
+            if value is None:
+                continue
+            aggregate = current['values'].get(key)
+            numeric = type(value) in (int, long, float)
+            if aggregate is None or not numeric or aggregate['type'] is None:
+                current['values'][key] = {'type': type(value) if numeric else None,
+                                          'sum': value if numeric else 0,
+                                          'count': 1,
+                                          'min': value,
+                                          'max': value,
+                                          'last': value}
+            else:
+                aggregate['sum'] += value
+                aggregate['count'] += 1
+                aggregate['min'] = min(aggregate['min'], value)
+                aggregate['max'] = max(aggregate['max'], value)
+                aggregate['last'] = value
+        return emitted
+
+    @staticmethod
+    def _emit(window, function):
+        values = {}
+        for key, aggregate in window['values'].iteritems():
+            if aggregate['type'] is None or function == 'last':
+                values[key] = aggregate['last']
+            elif function == 'mean':
+                mean = aggregate['sum'] / float(aggregate['count'])
+                # Keep the field type, as InfluxDB doesn't allow it to change
+                values[key] = aggregate['type'](round(mean)) if aggregate['type'] is not float else mean
+            else:
+                values[key] = aggregate[function]
+        metric = dict(window['metric'])
+        metric['timestamp'] = window['start']
+        metric['values'] = values
+        return metric
+
+
+class QueryCache(object):
+    """
+    A TTL and LRU bounded cache of query results. Results are keyed on the normalized query and the time bucket it
+    was run in, so relative queries (e.g. `now() - 1h`) move on every `ttl` seconds.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._ttl = 0
+        self._size = 0
+        self._entries = OrderedDict()  # (query, bucket) -> (expiry, result)
+        self._lock = Lock()
+
+    def configure(self, ttl, size):
+        with self._lock:
+            self._ttl = max(0, ttl)
+            self._size = max(1, size)
+            self._entries.clear()
+
+    @staticmethod
+    def normalize(query):
+        """
+        Collapses whitespace and drops trailing semicolons, leaving quoted strings and identifiers untouched
+        """
+        query = re.sub(r'(\'(?:[^\'\\]|\\.)*\'|"(?:[^"\\]|\\.)*")|\s+',
+                       lambda match: match.group(1) or ' ',
+                       query)
+        return query.strip().rstrip(';').strip()
+
+    def get(self, query):
+        with self._lock:
+            if self._ttl == 0 or self._size == 0:
+                return None
+            now = time.time()
+            key = (query, int(now // self._ttl))
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # Most recently used
+            self.hits += 1
+            return entry[1]
+
+    def put(self, query, result):
+        with self._lock:
+            if self._ttl == 0 or self._size == 0:
+                return
+            now = time.time()
+            for key in [key for key, entry in self._entries.iteritems() if entry[0] < now]:
+                del self._entries[key]
+            while len(self._entries) >= self._size:
+                self._entries.popitem(last=False)
+            self._entries[(query, int(now // self._ttl))] = (now + self._ttl, result)
+
+    def get_stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+class LineProtocolEncoder(object):
+    """
+    Encodes metrics to line protocol. The escaped series key (measurement and tag set) is cached, since the
+    same series recur every collection interval. The cache keeps two generations, which approximates an LRU
+    without any bookkeeping on a cache hit.
+    """
+
+    PRECISIONS = {'s': 1, 'ms': 1000, 'us': 1000000, 'ns': 1000000000}
+
+    def __init__(self, cache_size=4096):
+        self._cache_size = cache_size
+        self._series_keys = {}
+        self._previous_series_keys = {}
+        self._field_keys = {}
+
+    @staticmethod
+    def _to_str(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    @staticmethod
+    def _escape_measurement(value):
+        return LineProtocolEncoder._to_str(value).replace('\\', '\\\\').replace('\n', '\\n').replace(',', '\\,').replace(' ', '\\ ')
+
+    @staticmethod
+    def _escape_key(value):
+        return LineProtocolEncoder._escape_measurement(value).replace('=', '\\=')
+
+    def _get_series_key(self, metric):
+        cache_key = (metric['type'], metric['source'], frozenset(metric['tags'].iteritems()))
+        series_key = self._series_keys.get(cache_key)
+        if series_key is not None:
+            return series_key
+        series_key = self._previous_series_keys.get(cache_key)
+        if series_key is None:
+            tags = {'source': metric['source'].lower()}
+            tags.update(metric['tags'])
+            series_key = ','.join([LineProtocolEncoder._escape_measurement(metric['type'])] +
+                                  ['{0}={1}'.format(LineProtocolEncoder._escape_key(tag), LineProtocolEncoder._escape_key(tags[tag]))
+                                   for tag in sorted(tags)
+                                   if tags[tag] is not None and tags[tag] != ''])
+        if len(self._series_keys) >= self._cache_size:
+            self._previous_series_keys = self._series_keys
+            self._series_keys = {}
+        self._series_keys[cache_key] = series_key
+        return series_key
+
+    def _get_field_key(self, key):
+        if len(self._field_keys) >= self._cache_size:
+            self._field_keys = {}
+        field_key = self._field_keys[key] = LineProtocolEncoder._escape_key(key) + '='
+        return field_key
+
+    @staticmethod
+    def convert_precision(entry, from_precision, to_precision):
+        """
+        Converts the timestamp of an encoded entry from one precision (as a multiplier of seconds) to another
+        """
+        parts = entry.rsplit(' ', 1)
+        if len(parts) < 2 or not parts[1].isdigit():
+            return entry  # Entry without timestamp
+        return '{0} {1}'.format(parts[0], int(parts[1]) * to_precision // from_precision)
+
+    def encode(self, metric, precision=1000000000):
+        """
+        Returns a line protocol entry for the given metric, or None if it has no (valid) values
+        """
+        fields = []
+        field_keys = self._field_keys
+        for key, value in metric['values'].iteritems():
+            value_type = type(value)
+            if value_type is float:
+                value = str(value)
+            elif value_type is int:
+                value = str(value) + 'i'
+            elif value is None:
+                continue
+            elif value_type is bool:
+                value = 'true' if value else 'false'
+            elif isinstance(value, basestring):
+                value = '"' + LineProtocolEncoder._to_str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            else:
+                value = str(value)
+            field_key = field_keys.get(key)
+            if field_key is None:
+                field_key = self._get_field_key(key)
+            fields.append(field_key + value)
+        if len(fields) == 0:
+            return None
+        timestamp = metric.get('timestamp')
+        if timestamp is None:
+            return self._get_series_key(metric) + ' ' + ','.join(fields)
+        return '{0} {1} {2:.0f}'.format(self._get_series_key(metric), ','.join(fields), timestamp * precision)
+
+
+class Spool(object):
+    """
+    An append-only, segment rotated spool of line protocol entries on disk. Entries are read with `peek` and
+    only released with `commit` after they were send. The read position is checkpointed, so after a crash
+    entries are replayed at least once.
+    """
+
+    SEGMENT_SIZE = 1024 * 1024
+    PRECISION = 1000000000
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._directory = directory
+        self._lock = Lock()
+        self._segments = []  # Per segment: [sequence, unread entries, size in bytes]
+        self._read_offset = 0
+        self._next_sequence = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._recover()
+
+    def __len__(self):
+        return sum(segment[1] for segment in self._segments)
+
+    @property
+    def size(self):
+        return sum(segment[2] for segment in self._segments) - self._read_offset
+
+    def _segment_path(self, sequence):
+        return os.path.join(self._directory, '{0:010d}.lp'.format(sequence))
+
+    def _recover(self):
+        checkpoint_sequence, checkpoint_offset = None, 0
+        checkpoint_path = os.path.join(self._directory, 'checkpoint')
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r') as checkpoint_file:
+                checkpoint_sequence, checkpoint_offset = [int(part) for part in checkpoint_file.read().split()]
+        sequences = sorted(int(name[:-3]) for name in os.listdir(self._directory) if name.endswith('.lp'))
+        for sequence in sequences:
+            path = self._segment_path(sequence)
+            if checkpoint_sequence is not None and sequence < checkpoint_sequence:
+                os.remove(path)
+                continue
+            offset = checkpoint_offset if sequence == checkpoint_sequence else 0
+            with open(path, 'r+b') as segment_file:
+                content = segment_file.read()
+                end = content.rfind('\n') + 1
+                if end < len(content):
+                    # Drop an entry that was only partially written
+                    segment_file.truncate(end)
+            start = 0
+            if len(self._segments) == 0:
+                start = self._read_offset = min(offset, end)
+            self._segments.append([sequence, content.count('\n', start, end), end])
+        # An emptied spool only has its checkpoint left, and new segments must sort after it
+        self._next_sequence = checkpoint_sequence or 0
+        if len(sequences) > 0:
+            self._next_sequence = max(self._next_sequence, sequences[-1] + 1)
+
+    def _write_checkpoint(self):
+        if len(self._segments) > 0:
+            checkpoint = '{0} {1}'.format(self._segments[0][0], self._read_offset)
+        else:
+            checkpoint = '{0} 0'.format(self._next_sequence)
+        checkpoint_path = os.path.join(self._directory, 'checkpoint')
+        with open(checkpoint_path + '.tmp', 'w') as checkpoint_file:
+            checkpoint_file.write(checkpoint)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(checkpoint_path + '.tmp', checkpoint_path)
+
+    def remove(self):
+        """
+        Removes the spool from disk, with all entries in it
+        """
+        with self._lock:
+            self._segments = []
+            self._read_offset = 0
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    def append(self, entries):
+        content = ''.join(json.dumps(entry) + '\n' for entry in entries)
+        with self._lock:
+            if len(self._segments) == 0 or self._segments[-1][2] >= Spool.SEGMENT_SIZE:
+                self._segments.append([self._next_sequence, 0, 0])
+                self._next_sequence += 1
+            segment = self._segments[-1]
+            with open(self._segment_path(segment[0]), 'ab') as segment_file:
+                segment_file.write(content)
+            segment[1] += len(entries)
+            segment[2] += len(content)
+            while len(self._segments) > 1 and self.size > self.max_bytes:
+                # Drop the oldest segment to stay within the disk limit
+                sequence, unread, _ = self._segments.pop(0)
+                self.dropped += unread
+                self._read_offset = 0
+                os.remove(self._segment_path(sequence))
+                self._write_checkpoint()
+
+    def peek(self, amount):
+        """
+        Returns up to `amount` of the oldest entries, and the position to commit once they are processed
+        """
+        with self._lock:
+            if len(self._segments) == 0:
+                return [], None
+            sequence = self._segments[0][0]
+            entries = []
+            offset = self._read_offset
+            with open(self._segment_path(sequence), 'rb') as segment_file:
+                segment_file.seek(offset)
+                while len(entries) < amount:
+                    line = segment_file.readline()
+                    if not line.endswith('\n'):
+                        break
+                    entries.append(json.loads(line).encode('utf-8'))
+                    offset += len(line)
+            return entries, (sequence, offset, len(entries))
+
+    def commit(self, position):
+        with self._lock:
+            sequence, offset, amount = position
+            if len(self._segments) == 0 or self._segments[0][0] != sequence:
+                return  # The segment was dropped in the meantime
+            segment = self._segments[0]
+            segment[1] -= amount
+            self._read_offset = offset
+            if segment[1] <= 0 and offset >= segment[2]:
+                self._segments.pop(0)
+                self._read_offset = 0
+                os.remove(self._segment_path(sequence))
+            self._write_checkpoint()
@@ -3,11 +3,18 @@ An MQTT client plugin for sending/receiving data to/from an MQTT broker.
 For more info: https://github.com/openmotics/plugins/blob/master/mqtt-client/README.md
 """
 
+import os
 import sys
 import time
+import random
+import socket
+import string
+import struct
 import simplejson as json
-from threading import Thread
-from plugins.base import om_expose, input_status, output_status, OMPluginBase, PluginConfigChecker, receive_events
+from threading import Thread, Condition, Lock, Event
+from fnmatch import fnmatchcase
+from collections import deque, OrderedDict
+from plugins.base import om_expose, input_status, output_status, OMPluginBase, PluginConfigChecker, receive_events, background_task, om_metric_receive
 from serial_utils import CommunicationTimedOutException
 
 
@@ -18,7 +25,7 @@ class MQTTClient(OMPluginBase):
     """
 
     name = 'MQTTClient'
-    version = '1.3.2'
+    version = '1.3.18'
     interfaces = [('config', '1.0')]
 
     config_description = [{'name': 'broker_ip',
@@ -32,10 +39,99 @@ class MQTTClient(OMPluginBase):
                            'description': 'Username'},
                           {'name': 'password',
                            'type': 'str',
-                           'description': 'Password'}]
+                           'description': 'Password'},
+                          {'name': 'keepalive',
+                           'type': 'int',
+                           'description': 'The interval (in seconds) at which the connection to the MQTT broker is checked. Default: 30'},
+                          {'name': 'max_backoff',
+                           'type': 'int',
+                           'description': 'The maximum time (in seconds) between attempts to reconnect to the MQTT broker. Default: 60'},
+                          {'name': 'refresh_interval',
+                           'type': 'int',
+                           'description': 'The interval (in seconds) at which changes to the input and output configuration are picked up, 0 to disable. Default: 300'},
+                          {'name': 'command_window',
+                           'type': 'int',
+                           'description': 'The time (in milliseconds) output commands are collected, so only the last command per output is executed. Default: 100'},
+                          {'name': 'state_interval',
+                           'type': 'int',
+                           'description': 'The minimum time (in seconds) between updates of the retained state topics (openmotics/state/#), 0 to disable. Default: 5'},
+                          {'name': 'publish_queue_size',
+                           'type': 'int',
+                           'description': 'The maximum amount of messages waiting to be published. When full, the oldest messages are dropped. Default: 1000'},
+                          {'name': 'publishers',
+                           'type': 'int',
+                           'description': 'The amount of threads (1-4) publishing messages. Messages on the same topic are always published in order. Default: 1'},
+                          {'name': 'client_id',
+                           'type': 'str',
+                           'description': 'The client ID, identifying the persistent session on the MQTT broker. Default: openmotics-<hostname>-<random>, generated once'},
+                          {'name': 'output_qos',
+                           'type': 'int',
+                           'description': 'The QoS level (0-2) of output events (openmotics/events/output/#). Default: 1'},
+                          {'name': 'input_qos',
+                           'type': 'int',
+                           'description': 'The QoS level (0-2) of input events (openmotics/events/input/#). Default: 1'},
+                          {'name': 'event_qos',
+                           'type': 'int',
+                           'description': 'The QoS level (0-2) of events (openmotics/events/event/#). Default: 1'},
+                          {'name': 'logging_qos',
+                           'type': 'int',
+                           'description': 'The QoS level (0-2) of log messages (openmotics/logging). Default: 0'},
+                          {'name': 'logging_level',
+                           'type': 'enum',
+                           'choices': ['info', 'error', 'off'],
+                           'description': 'The log messages published (openmotics/logging): all, errors only or none. Default: info'},
+                          {'name': 'logging_interval',
+                           'type': 'int',
+                           'description': 'The interval (in seconds) at which log messages are published, as one message. Default: 1'},
+                          {'name': 'logging_rate',
+                           'type': 'int',
+                           'description': 'The maximum amount of log messages per second, the rest is dropped. Default: 20'},
+                          {'name': 'output_format',
+                           'type': 'enum',
+                           'choices': ['json', 'json_minimal', 'binary'],
+                           'description': 'The payload format of output events. Default: json'},
+                          {'name': 'input_format',
+                           'type': 'enum',
+                           'choices': ['json', 'json_minimal', 'binary'],
+                           'description': 'The payload format of input events. Default: json'},
+                          {'name': 'event_format',
+                           'type': 'enum',
+                           'choices': ['json', 'json_minimal', 'binary'],
+                           'description': 'The payload format of events. Default: json'},
+                          {'name': 'outbox_size',
+                           'type': 'int',
+                           'description': 'The maximum amount of messages (with QoS 1 or 2) kept in memory while the MQTT broker is unreachable. Default: 1000'},
+                          {'name': 'outbox_spill',
+                           'type': 'bool',
+                           'description': 'Write messages to disk when the outbox in memory is full.'},
+                          {'name': 'outbox_rate',
+                           'type': 'int',
+                           'description': 'The maximum amount of messages per second published from the outbox once the MQTT broker is reachable again. Default: 20'},
+                          {'name': 'metrics',
+                           'type': 'section',
+                           'description': 'Metric types (wildcards allowed) to publish. The topic can contain {source}, {type} and tags (e.g. {id}), '
+                                          'default: openmotics/metrics/{source}/{type}. The interval (in seconds) limits how often a series is published.',
+                           'repeat': True,
+                           'min': 0,
+                           'content': [{'name': 'type', 'type': 'str'},
+                                       {'name': 'topic', 'type': 'str'},
+                                       {'name': 'interval', 'type': 'int'},
+                                       {'name': 'batch', 'type': 'bool'}]},
+                          {'name': 'metric_batch_interval',
+                           'type': 'int',
+                           'description': 'The interval (in seconds) at which batched metrics are published, as one message per topic. Default: 10'},
+                          {'name': 'metric_queue_size',
+                           'type': 'int',
+                           'description': 'The maximum amount of metrics waiting to be published, apart from the events. When full, the oldest metrics are dropped. Default: 1000'}]
 
     default_config = {'broker_port': 1883}
 
+    # Per topic family: the config key of its payload format, and the fields (and their packing) that aren't
+    # static or already part of the topic
+    payload_formats = [('openmotics/events/output/', 'output_format', ['value', 'timestamp'], '!Bd'),
+                       ('openmotics/events/input/', 'input_format', ['timestamp'], '!d'),
+                       ('openmotics/events/event/', 'event_format', ['timestamp'], '!d')]
+
     def __init__(self, webinterface, logger):
         super(MQTTClient, self).__init__(webinterface, logger)
         self.logger('Starting MQTTClient plugin...')
@@ -48,13 +144,37 @@ class MQTTClient(OMPluginBase):
             sys.path.insert(0, paho_mqtt_egg)
 
         self.client = None
+        self._client_id = None
+        self._connected = False
+        self._connection = None
+        self._connection_lock = Lock()
+        self._connection_stats = {'connects': 0, 'disconnects': 0, 'failures': 0, 'messages': 0, 'bytes': 0, 'throttled': 0}
+        self._connection_stats_lock = Lock()
+        self._publisher = Publisher(self._publish, self.logger)
+        self._outbox = Outbox(self._publish_now,
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outbox.json'),
+                              self.logger)
+        self._dispatcher = Dispatcher(self._set_output, self.logger)
+        # Metrics have their own queue, so a burst of metrics can't push events out of the publish queue
+        self._metric_queue = Publisher(self._publish, self.logger, name='metric publisher')
+        self._metric_publisher = MetricPublisher(self._metric_queue.put, self.logger)
+        self._log_channel = LogChannel(self._send, self.logger)
         self._outputs = {}
+        self._on_outputs = {}  # Index of the outputs that are on, and their dimmer value
         self._inputs = {}
+        self._snapshot = {}  # The last configuration responses, to skip unchanged ones
+        self._refresh_event = Event()
+        self._refresh_full = False
+        self._input_presses = {}  # The last time every input was pressed
+        self._state_changes = set()
+        self._state_lock = Lock()
+        self._state_event = Event()
+        self._state_dump = False
 
         self._read_config()
-        self._try_connect()
+        self._connect()
 
-        self._load_configuration()
+        self._load_configuration(full=True)
 
         self.logger("Started MQTTClient plugin")
 
@@ -63,95 +183,363 @@ class MQTTClient(OMPluginBase):
         self._port = self._config.get('broker_port', MQTTClient.default_config['broker_port'])
         self._username = self._config.get('username')
         self._password = self._config.get('password')
+        self._keepalive = max(5, self._config.get('keepalive', 30))
+        self._max_backoff = max(1, self._config.get('max_backoff', 60))
+        self._refresh_interval = max(0, self._config.get('refresh_interval', 300))
+        self._state_interval = max(0, self._config.get('state_interval', 5))
+        self._client_id = self._config.get('client_id') or self._client_id
+        if not self._client_id:
+            # Gateways often keep the stock hostname, so a random part (saved with the config) keeps the ID unique
+            self._client_id = 'openmotics-{0}-{1:06x}'.format(socket.gethostname(), random.getrandbits(24))
+        if self._config.get('client_id') != self._client_id:
+            self._config['client_id'] = self._client_id
+            self.write_config(self._config)
+        self._qos = [('openmotics/events/output/', self._get_qos('output_qos', 1)),
+                     ('openmotics/state/', self._get_qos('output_qos', 1)),
+                     ('openmotics/events/input/', self._get_qos('input_qos', 1)),
+                     ('openmotics/events/event/', self._get_qos('event_qos', 1)),
+                     ('openmotics/logging', self._get_qos('logging_qos', 0))]
+        self._formats = [(prefix, self._config.get(key, 'json'), fields, packing)
+                         for prefix, key, fields, packing in MQTTClient.payload_formats]
+        self._publisher.configure(self._config.get('publish_queue_size', 1000),
+                                  self._config.get('publishers', 1))
+        self._outbox.configure(self._config.get('outbox_size', 1000),
+                               self._config.get('outbox_spill', False),
+                               self._config.get('outbox_rate', 20))
+        self._dispatcher.window = max(0, self._config.get('command_window', 100)) / 1000.0
+        self._metric_publisher.configure(self._config.get('metrics', []),
+                                         self._config.get('metric_batch_interval', 10))
+        self._metric_queue.configure(self._config.get('metric_queue_size', 1000), 1)
+        self._log_channel.configure(self._config.get('logging_level', 'info'),
+                                    self._config.get('logging_interval', 1),
+                                    self._config.get('logging_rate', 20))
 
         self._enabled = self._ip is not None and self._port is not None
         self.logger('MQTTClient is {0}'.format('enabled' if self._enabled else 'disabled'))
 
-    def _load_configuration(self):
+    def _get_qos(self, key, default):
+        return max(0, min(2, self._config.get(key, default)))
+
+    def _request_refresh(self, full=False):
+        self._refresh_full = self._refresh_full or full
+        self._refresh_event.set()
+
+    @background_task
+    def refresh(self):
+        """
+        Refreshes the configuration periodically or on request, apart from the event handlers, so publishing is
+        never held back by the (slow) configuration calls
+        """
+        while True:
+            if self._enabled is True and self._refresh_interval > 0:
+                # A timed wait polls on Python 2, so look for a requested refresh once a second instead
+                deadline = time.time() + self._refresh_interval
+                while self._refresh_event.is_set() is False and time.time() < deadline:
+                    time.sleep(1)
+            else:
+                self._refresh_event.wait()
+            self._refresh_event.clear()
+            full, self._refresh_full = self._refresh_full, False
+            if self._enabled is True:
+                self._load_configuration(full=full)
+
+    def _get_configuration(self, name, call):
+        """
+        Returns the parsed response of a configuration call, or None when it's unchanged since the last call
+        """
+        response = call(None)
+        if response == self._snapshot.get(name):
+            return None
+        result = json.loads(response)
+        if result['success'] is False:
+            self.logger('Failed to load {0} configurations'.format(name))
+            return None
+        self._snapshot[name] = response
+        return result
+
+    def _load_configuration(self, full=False):
+        """
+        Applies only what changed to the known inputs and outputs. The output status is reloaded on a full
+        refresh, or when outputs were added.
+        """
+        if full is True:
+            self._snapshot = {}
+        changed_inputs = 0
+        changed_outputs = 0
+        new_outputs = False
         # Inputs
         try:
-            result = json.loads(self.webinterface.get_input_configurations(None))
-            if result['success'] is False:
-                self.logger('Failed to load input configurations')
-            else:
-                ids = []
+            result = self._get_configuration('input', self.webinterface.get_input_configurations)
+            if result is not None:
+                ids = set()
                 for config in result['config']:
                     input_id = config['id']
-                    ids.append(input_id)
-                    self._inputs[input_id] = config
+                    ids.add(input_id)
+                    if self._inputs.get(input_id) != config:
+                        self._inputs[input_id] = config
+                        changed_inputs += 1
                 for input_id in self._inputs.keys():
                     if input_id not in ids:
                         del self._inputs[input_id]
+                        changed_inputs += 1
         except CommunicationTimedOutException:
             self.logger('Error while loading input configurations: CommunicationTimedOutException')
         except Exception as ex:
             self.logger('Error while loading input configurations: {0}'.format(ex))
         # Outputs
         try:
-            result = json.loads(self.webinterface.get_output_configurations(None))
-            if result['success'] is False:
-                self.logger('Failed to load output configurations')
-            else:
-                ids = []
+            result = self._get_configuration('output', self.webinterface.get_output_configurations)
+            if result is not None:
+                ids = set()
                 for config in result['config']:
                     if config['module_type'] not in ['o', 'O', 'd', 'D']:
                         continue
                     output_id = config['id']
-                    ids.append(output_id)
-                    self._outputs[output_id] = {'name': config['name'],
-                                                'module_type': {'o': 'output',
-                                                                'O': 'output',
-                                                                'd': 'dimmer',
-                                                                'D': 'dimmer'}[config['module_type']],
-                                                'floor': config['floor'],
-                                                'type': 'relay' if config['type'] == 0 else 'light'}
+                    ids.add(output_id)
+                    output_config = {'name': config['name'],
+                                     'module_type': {'o': 'output',
+                                                     'O': 'output',
+                                                     'd': 'dimmer',
+                                                     'D': 'dimmer'}[config['module_type']],
+                                     'floor': config['floor'],
+                                     'type': 'relay' if config['type'] == 0 else 'light'}
+                    output = self._outputs.get(output_id)
+                    if output is None:
+                        self._outputs[output_id] = output_config
+                        changed_outputs += 1
+                        new_outputs = True
+                    elif any(output.get(key) != value for key, value in output_config.iteritems()):
+                        # Updated in place, keeping the known status
+                        output.update(output_config)
+                        changed_outputs += 1
                 for output_id in self._outputs.keys():
                     if output_id not in ids:
                         del self._outputs[output_id]
+                        self._on_outputs.pop(output_id, None)
+                        changed_outputs += 1
         except CommunicationTimedOutException:
             self.logger('Error while loading output configurations: CommunicationTimedOutException')
         except Exception as ex:
             self.logger('Error while loading output configurations: {0}'.format(ex))
-        try:
-            result = json.loads(self.webinterface.get_output_status(None))
-            if result['success'] is False:
-                self.logger('Failed to get output status')
-            else:
-                for output in result['status']:
-                    output_id = output['id']
-                    if output_id not in self._outputs:
-                        continue
-                    self._outputs[output_id]['status'] = output['status']
-                    self._outputs[output_id]['dimmer'] = output['dimmer']
-        except CommunicationTimedOutException:
-            self.logger('Error getting output status: CommunicationTimedOutException')
-        except Exception as ex:
-            self.logger('Error getting output status: {0}'.format(ex))
+        if full is True or new_outputs is True:
+            try:
+                result = json.loads(self.webinterface.get_output_status(None))
+                if result['success'] is False:
+                    self.logger('Failed to get output status')
+                else:
+                    for output in result['status']:
+                        output_id = output['id']
+                        if output_id not in self._outputs:
+                            continue
+                        self._outputs[output_id]['status'] = output['status']
+                        self._outputs[output_id]['dimmer'] = output['dimmer']
+            except CommunicationTimedOutException:
+                self.logger('Error getting output status: CommunicationTimedOutException')
+            except Exception as ex:
+                self.logger('Error getting output status: {0}'.format(ex))
+            self._on_outputs = dict((output_id, output['dimmer']) for output_id, output in self._outputs.iteritems()
+                                    if output.get('status') == 1 and output.get('dimmer') is not None)
+            self._state_changed('outputs')
+        if changed_inputs > 0:
+            self._state_changed('inputs')
+        if changed_inputs > 0 or changed_outputs > 0:
+            self.logger('Configuration refreshed: {0} input(s) and {1} output(s) changed'.format(changed_inputs, changed_outputs))
 
-    def _try_connect(self):
-        if self._enabled is True:
+    def _connect(self):
+        """
+        (Re)creates the MQTT client. The previous client is disconnected and its thread is stopped first, so
+        changing the config doesn't leak threads or sockets.
+        """
+        with self._connection_lock:
+            self._disconnect()
+            if self._enabled is False:
+                return
             try:
                 import paho.mqtt.client as client
-                self.client = client.Client()
+                # A persistent session, so the broker keeps the subscriptions and unacknowledged messages
+                mqtt_client = client.Client(client_id=self._client_id, clean_session=False)
+                # Unacknowledged messages are retried by paho, everything beyond that waits in the outbox
+                mqtt_client.max_inflight_messages_set(20)
+                mqtt_client.max_queued_messages_set(100)
                 if self._username is not None:
                     self.logger("MQTTClient is using username/password")
-                    self.client.username_pw_set(self._username, self._password)
-                self.client.on_message = self.on_message
-                self.client.on_connect = self.on_connect
-                self.client.connect(self._ip, self._port, 5)
-                self.client.loop_start()
+                    mqtt_client.username_pw_set(self._username, self._password)
+                mqtt_client.on_message = self.on_message
+                mqtt_client.on_connect = self.on_connect
+                mqtt_client.on_disconnect = self.on_disconnect
+            except Exception as ex:
+                self.logger('Error creating MQTT client: {0}'.format(ex))
+                return
+            stop = Event()
+            thread = Thread(target=self._run_connection, args=(mqtt_client, stop))
+            thread.setName('MQTTClient connection')
+            thread.daemon = True
+            self.client = mqtt_client
+            self._connection = (thread, stop)
+            thread.start()
+
+    def _disconnect(self):
+        if self._connection is None:
+            return
+        thread, stop = self._connection
+        self._connection = None
+        stop.set()
+        self._connected = False
+        try:
+            self.client.disconnect()
+        except Exception as ex:
+            self.logger('Error disconnecting from MQTT broker: {0}'.format(ex))
+        thread.join(10)
+
+    def _run_connection(self, client, stop):
+        """
+        Runs the network loop of a client, and reconnects with a jittered exponential backoff when the
+        connection fails or drops
+        """
+        backoff = 0
+        connected_before = False
+        while not stop.is_set():
+            try:
+                if connected_before is False:
+                    client.connect(self._ip, self._port, self._keepalive)
+                    connected_before = True
+                else:
+                    client.reconnect()
+                rc = 0
+                while rc == 0 and not stop.is_set():
+                    rc = client.loop(timeout=1.0)
+                    if self._connected is True:
+                        backoff = 0
+                error = 'rc={0}'.format(rc)
             except Exception as ex:
-                self.logger('Error connecting to MQTT broker: {0}'.format(ex))
+                error = ex
+            if stop.is_set():
+                break
+            with self._connection_stats_lock:
+                self._connection_stats['failures'] += 1
+            if backoff == 0:
+                self.logger('Error connecting to MQTT broker: {0}, retrying'.format(error))
+            backoff = min(self._max_backoff, max(1, backoff * 2))
+            stop.wait(random.uniform(backoff / 2.0, backoff))
 
-    def _log(self, info):
-        thread = Thread(target=self._send, args=('openmotics/logging', info), kwargs={'retain': False})
-        thread.start()
+    def _log(self, info, level='info'):
+        self._log_channel.log(info, level)
 
     def _send(self, topic, data, retain=True):
+        self._publisher.put(topic, data, retain)
+
+    def _publish(self, topic, data, retain):
+        """
+        Called by the publisher threads
+        """
+        qos = 0
+        for prefix, prefix_qos in self._qos:
+            if topic.startswith(prefix):
+                qos = prefix_qos
+                break
+        self._outbox.publish((topic, data, retain, qos))
+
+    def _publish_now(self, topic, data, retain, qos):
+        """
+        Returns whether the message was handed over to paho
+        """
+        if self._connected is False:
+            return False
         try:
-            self.client.publish(topic, json.dumps(data), retain=retain)
+            payload = self._encode(topic, data)
+            while True:
+                result = self.client.publish(topic, payload, qos=qos, retain=retain)
+                rc = result[0] if isinstance(result, tuple) else result.rc
+                if rc != 15 or self._connected is False:  # 15: MQTT_ERR_QUEUE_SIZE
+                    break
+                # Paho's queue is full while the broker is reachable, so wait for it to drain (holding back the
+                # publishers) instead of holding the message in the outbox
+                with self._connection_stats_lock:
+                    self._connection_stats['throttled'] += 1
+                time.sleep(0.01)
         except Exception as ex:
             self.logger('Error sending data to broker: {0}'.format(ex))
+            raise
+        with self._connection_stats_lock:
+            self._connection_stats['messages'] += 1
+            self._connection_stats['bytes'] += len(payload)
+        # Paho keeps a QoS 1/2 message that couldn't be send yet, and sends it after reconnecting
+        return rc == 0 or (rc == 4 and qos > 0)  # 4: MQTT_ERR_NO_CONN
+
+    def _encode(self, topic, data):
+        for prefix, payload_format, fields, packing in self._formats:
+            if topic.startswith(prefix):
+                if payload_format == 'json_minimal':
+                    return json.dumps(dict((field, data[field]) for field in fields))
+                if payload_format == 'binary':
+                    return bytearray(struct.pack(packing, *[data[field] for field in fields]))
+                break
+        return json.dumps(data)
+
+    def _state_changed(self, name):
+        with self._state_lock:
+            self._state_changes.add(name)
+        self._state_event.set()
+
+    @background_task
+    def publish_state(self):
+        """
+        Publishes the retained state topics when something changed, at most once every `state_interval`, so
+        a burst of changes results in a single update
+        """
+        while True:
+            self._state_event.wait()
+            if self._state_dump is False:
+                if self._state_interval == 0:
+                    self._state_event.clear()
+                    continue
+                time.sleep(self._state_interval)
+            self._state_event.clear()
+            with self._state_lock:
+                changes, self._state_changes = self._state_changes, set()
+                dump, self._state_dump = self._state_dump, False
+            if self._enabled is False:
+                continue
+            try:
+                if self._state_interval == 0:
+                    changes = set()
+                if 'outputs' in changes:
+                    self._send('openmotics/state/outputs', self._get_output_state())
+                if 'inputs' in changes:
+                    self._send('openmotics/state/inputs', self._get_input_state())
+                if dump is True:
+                    self._send('openmotics/state/dump', {'outputs': self._get_output_state(details=True),
+                                                         'inputs': self._get_input_state()},
+                               retain=False)
+            except Exception as ex:
+                self.logger('Error publishing state: {0}'.format(ex))
+
+    def _get_output_state(self, details=False):
+        state = {}
+        for output_id, output in self._outputs.items():
+            status = output.get('status')
+            if status is None:
+                continue
+            if status == 0:
+                level = 0
+            elif output['module_type'] == 'output':
+                level = 100
+            else:
+                level = output.get('dimmer')
+            if details is True:
+                state[output_id] = {'name': output['name'],
+                                    'module_type': output['module_type'],
+                                    'floor': output['floor'],
+                                    'type': output['type'],
+                                    'value': level}
+            else:
+                state[output_id] = level
+        return state
+
+    def _get_input_state(self):
+        return dict((input_id, {'name': config.get('name'),
+                                'last_pressed': self._input_presses.get(input_id)})
+                    for input_id, config in self._inputs.items())
 
     @input_status
     def input_status(self, status):
@@ -165,8 +553,9 @@ class MQTTClient(OMPluginBase):
                     data = {'id': input_id,
                             'name': name,
                             'timestamp': time.time()}
-                    thread = Thread(target=self._send, args=('openmotics/events/input/{0}'.format(input_id), data))
-                    thread.start()
+                    self._send('openmotics/events/input/{0}'.format(input_id), data)
+                    self._input_presses[input_id] = data['timestamp']
+                    self._state_changed('inputs')
                 else:
                     self.logger('Got event for unknown input {0}'.format(input_id))
             except Exception as ex:
@@ -174,51 +563,86 @@ class MQTTClient(OMPluginBase):
 
     @output_status
     def output_status(self, status):
+        """
+        Receives the outputs that are on. Only these and the outputs that were on before are looked at, so the
+        cost doesn't grow with the amount of outputs in the installation.
+        """
         if self._enabled is True:
             try:
                 on_outputs = {}
                 for entry in status:
                     on_outputs[entry[0]] = entry[1]
-                outputs = self._outputs
-                for output_id in outputs:
-                    status = outputs[output_id].get('status')
-                    dimmer = outputs[output_id].get('dimmer')
-                    name = outputs[output_id].get('name')
-                    if status is None or dimmer is None:
-                        continue
-                    changed = False
-                    if output_id in on_outputs:
-                        if status != 1:
-                            changed = True
-                            outputs[output_id]['status'] = 1
-                            self._log('Output {0} ({1}) changed to ON'.format(output_id, name))
-                            self.logger('Output {0} changed to ON'.format(output_id))
-                        if dimmer != on_outputs[output_id]:
-                            changed = True
-                            outputs[output_id]['dimmer'] = on_outputs[output_id]
-                            self._log('Output {0} ({1}) changed to level {2}'.format(output_id, name, on_outputs[output_id]))
-                            self.logger('Output {0} changed to level {1}'.format(output_id, on_outputs[output_id]))
-                    elif status != 0:
-                        changed = True
-                        outputs[output_id]['status'] = 0
-                        self._log('Output {0} ({1}) changed to OFF'.format(output_id, name))
-                        self.logger('Output {0} changed to OFF'.format(output_id))
-                    if changed is True:
-                        if outputs[output_id]['module_type'] == 'output':
-                            level = 100
-                        else:
-                            level = dimmer
-                        if outputs[output_id]['status'] == 0:
-                            level = 0
-                        data = {'id': output_id,
-                                'name': name,
-                                'value': level,
-                                'timestamp': time.time()}
-                        thread = Thread(target=self._send, args=('openmotics/events/output/{0}'.format(output_id), data))
-                        thread.start()
+                previous_on_outputs = self._on_outputs
+                off_outputs = [output_id for output_id in previous_on_outputs if output_id not in on_outputs]
+                for output_id, dimmer in on_outputs.iteritems():
+                    if previous_on_outputs.get(output_id) != dimmer:
+                        self._output_changed(output_id, 1, dimmer)
+                for output_id in off_outputs:
+                    self._output_changed(output_id, 0, None)
             except Exception as ex:
                 self.logger('Error processing outputs: {0}'.format(ex))
 
+    def _output_changed(self, output_id, new_status, new_dimmer):
+        output = self._outputs.get(output_id)
+        if output is None:
+            return
+        status = output.get('status')
+        dimmer = output.get('dimmer')
+        name = output.get('name')
+        if status is None or dimmer is None:
+            return
+        changed = False
+        if new_status == 1:
+            if status != 1:
+                changed = True
+                output['status'] = 1
+                self._log('Output {0} ({1}) changed to ON'.format(output_id, name))
+                self.logger('Output {0} changed to ON'.format(output_id))
+            if dimmer != new_dimmer:
+                changed = True
+                output['dimmer'] = new_dimmer
+                self._log('Output {0} ({1}) changed to level {2}'.format(output_id, name, new_dimmer))
+                self.logger('Output {0} changed to level {1}'.format(output_id, new_dimmer))
+            self._on_outputs[output_id] = new_dimmer
+        else:
+            self._on_outputs.pop(output_id, None)
+            if status != 0:
+                changed = True
+                output['status'] = 0
+                self._log('Output {0} ({1}) changed to OFF'.format(output_id, name))
+                self.logger('Output {0} changed to OFF'.format(output_id))
+        if changed is True:
+            if output['module_type'] == 'output':
+                level = 100
+            else:
+                level = dimmer
+            if output['status'] == 0:
+                level = 0
+            data = {'id': output_id,
+                    'name': name,
+                    'value': level,
+                    'timestamp': time.time()}
+            self._send('openmotics/events/output/{0}'.format(output_id), data)
+            self._state_changed('outputs')
+
+    @om_metric_receive(interval=10)
+    def _receive_metric_data(self, metric):
+        """
+        Publishes the metrics of the configured types
+        > example_metric = {"source": "OpenMotics",
+        >                   "type": "energy",
+        >                   "timestamp": 1497677091,
+        >                   "tags": {"device": "OpenMotics energy ID1",
+        >                            "id": 0},
+        >                   "values": {"power": 1234,
+        >                              "power_counter": 1234567}}
+        """
+        if self._enabled is True:
+            try:
+                self._metric_publisher.receive(metric)
+            except Exception as ex:
+                self.logger('Error receiving metrics: {0}'.format(ex))
+
     @receive_events
     def recv_events(self, id):
         if self._enabled is True:
@@ -226,55 +650,108 @@ class MQTTClient(OMPluginBase):
                 self.logger('Got event {0}'.format(id))
                 data = {'id': id,
                         'timestamp': time.time()}
-                thread = Thread(target=self._send, args=('openmotics/events/event/{0}'.format(id), data))
-                thread.start()
+                self._send('openmotics/events/event/{0}'.format(id), data)
             except Exception as ex:
                 self.logger('Error processing event: {0}'.format(ex))
 
     def on_connect(self, client, userdata, flags, rc):
+        if client is not self.client:
+            return
         if rc != 0:
-            self.logger('Error connecting: rc={0}', rc)
+            self.logger('Error connecting: rc={0}'.format(rc))
             return
 
         self.logger('Connected to MQTT broker {0}:{1}'.format(self._ip, self._port))
+        self._connected = True
+        with self._connection_stats_lock:
+            self._connection_stats['connects'] += 1
+        self._outbox.resume()
         try:
-            self.client.subscribe('openmotics/set/output/#')
-            self.logger('Subscribed to openmotics/set/output/#')
+            # With QoS 0 the broker doesn't queue commands for the persistent session while the gateway is offline,
+            # so no outdated commands switch outputs after a reconnect
+            self.client.subscribe([('openmotics/set/output/#', 0),
+                                   ('openmotics/set/outputs', 0),
+                                   ('openmotics/state/request', 0)])
+            self.logger('Subscribed to openmotics/set/output/#, openmotics/set/outputs and openmotics/state/request')
         except Exception as ex:
             self.logger('Could not subscribe: {0}'.format(ex))
 
+    def on_disconnect(self, client, userdata, rc):
+        if client is not self.client:
+            return
+        self._connected = False
+        with self._connection_stats_lock:
+            self._connection_stats['disconnects'] += 1
+        self.logger('Disconnected from MQTT broker {0}:{1} (rc={2})'.format(self._ip, self._port, rc))
+
     def on_message(self, client, userdata, msg):
+        """
+        Runs on paho's network thread, so the commands are only queued here and executed by the dispatcher
+        """
         base_topic = 'openmotics/set/output/'
-        if msg.topic.startswith(base_topic):
-            try:
-                output_id = int(msg.topic.replace(base_topic, ''))
-                if output_id in self._outputs:
-                    output = self._outputs[output_id]
-                    value = int(msg.payload)
-                    if value > 0:
-                        is_on = 'true'
-                        log_value = 'ON'
-                    else:
-                        is_on = 'false'
-                        log_value = 'OFF'
-                    dimmer = None
-                    if output['module_type'] == 'dimmer':
-                        dimmer = None if value == 0 else max(0, min(100, value))
-                        if value > 0:
-                            log_value = 'ON ({0}%)'.format(value)
-                    result = json.loads(self.webinterface.set_output(None, output_id, is_on, dimmer, None))
-                    if result['success'] is False:
-                        log_message = 'Failed to set output {0} to {1}: {2}'.format(output_id, log_value, result.get('msg', 'Unknown error'))
-                        self._log(log_message)
-                        self.logger(log_message)
-                    else:
-                        log_message = 'Output {0} set to {1}'.format(output_id, log_value)
-                        self._log(log_message)
-                        self.logger(log_message)
-                else:
-                    self._log('Unknown output: {0}'.format(output_id))
-            except Exception as ex:
-                self._log('Failed to process message: {0}'.format(ex))
+        try:
+            if msg.topic.startswith(base_topic):
+                self._queue_command(int(msg.topic.replace(base_topic, '')), msg.payload)
+            elif msg.topic == 'openmotics/set/outputs':
+                for output_id, value in json.loads(msg.payload, object_pairs_hook=OrderedDict).iteritems():
+                    self._queue_command(int(output_id), value)
+            elif msg.topic == 'openmotics/state/request':
+                with self._state_lock:
+                    self._state_dump = True
+                self._state_event.set()
+        except Exception as ex:
+            self._log('Failed to process message: {0}'.format(ex), level='error')
+
+    def _queue_command(self, output_id, value):
+        if output_id in self._outputs:
+            self._dispatcher.put(output_id, int(value))
+        else:
+            self._log('Unknown output: {0}'.format(output_id), level='error')
+
+    def _set_output(self, output_id, value):
+        output = self._outputs.get(output_id)
+        if output is None:
+            self._log('Unknown output: {0}'.format(output_id), level='error')
+            return
+        if value > 0:
+            is_on = 'true'
+            log_value = 'ON'
+        else:
+            is_on = 'false'
+            log_value = 'OFF'
+        dimmer = None
+        if output['module_type'] == 'dimmer':
+            dimmer = None if value == 0 else max(0, min(100, value))
+            if value > 0:
+                log_value = 'ON ({0}%)'.format(value)
+        result = json.loads(self.webinterface.set_output(None, output_id, is_on, dimmer, None))
+        if result['success'] is False:
+            log_message = 'Failed to set output {0} to {1}: {2}'.format(output_id, log_value, result.get('msg', 'Unknown error'))
+            self._log(log_message, level='error')
+            self.logger(log_message)
+        else:
+            log_message = 'Output {0} set to {1}'.format(output_id, log_value)
+            self._log(log_message)
+            self.logger(log_message)
+
+    @om_expose
+    def refresh_configuration(self):
+        """ Reloads the input and output configuration, e.g. after changing it on the gateway. """
+        self._request_refresh(full=True)
+        return json.dumps({'success': True})
+
+    @om_expose
+    def get_stats(self):
+        with self._connection_stats_lock:
+            connection = dict(self._connection_stats)
+        connection['connected'] = self._connected
+        return json.dumps({'connection': connection,
+                           'publisher': self._publisher.get_stats(),
+                           'commands': self._dispatcher.get_stats(),
+                           'metrics': self._metric_publisher.get_stats(),
+                           'metric_publisher': self._metric_queue.get_stats(),
+                           'logging': self._log_channel.get_stats(),
+                           'outbox': self._outbox.get_stats()})
 
     @om_expose
     def get_config_description(self):
@@ -291,12 +768,472 @@ class MQTTClient(OMPluginBase):
         config['broker_ip'] = config['broker_ip'].encode('ascii', 'ignore')
         config['username'] = config['username'].encode('ascii', 'ignore')
         config['password'] = config['password'].encode('ascii', 'ignore')
+        if 'client_id' in config:
+            config['client_id'] = config['client_id'].encode('ascii', 'ignore')
         self._config_checker.check_config(config)
         self.write_config(config)
         self._config = config
         self._read_config()
         if self._enabled:
-            thread = Thread(target=self._load_configuration)
-            thread.start()
-        self._try_connect()
+            self._request_refresh(full=True)
+        self._connect()
         return json.dumps({'success': True})
+
+
+class Publisher(object):
+    """
+    Publishes messages from a bounded queue, using a few long-running threads instead of a thread per message.
+    All messages for a topic are handled by the same thread, so they are published in order.
+    """
+
+    def __init__(self, publish, logger, name='publisher'):
+        self._publish = publish
+        self.logger = logger
+        self.name = name
+        self._condition = Condition()
+        self._queues = []
+        self._max_size = 0
+        self._worker_count = 0
+        self._threads = []
+        self._overflowing = False
+        self._stats_lock = Lock()
+        self._counters = {'queued': 0, 'published': 0, 'dropped': 0, 'errors': 0}
+        self._rate = 0.0
+        self._rate_start = time.time()
+        self._rate_published = 0
+
+    def configure(self, queue_size, worker_count):
+        with self._condition:
+            worker_count = max(1, min(4, worker_count))
+            self._max_size = max(1, queue_size / worker_count)
+            if worker_count != self._worker_count:
+                # Redistribute what's still waiting, keeping the order per topic
+                pending = [message for queue in self._queues for message in reversed(queue)]
+                self._queues = [deque() for _ in xrange(worker_count)]
+                self._worker_count = worker_count
+                for message in pending:
+                    self._queues[hash(message[0]) % worker_count].appendleft(message)
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            for index in xrange(len(self._threads), worker_count):
+                thread = Thread(target=self._worker, args=(index,))
+                thread.setName('MQTTClient {0} {1}'.format(self.name, index))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            # Wake up all workers, so they pick up their new queue (or stop when no longer needed)
+            self._condition.notify_all()
+
+    def put(self, topic, data, retain):
+        with self._condition:
+            queue = self._queues[hash(topic) % self._worker_count]
+            if len(queue) >= self._max_size:
+                queue.pop()
+                self._count('dropped')
+                if self._overflowing is False:
+                    self._overflowing = True
+                    self.logger('Queue of the {0} is full, dropping the oldest messages'.format(self.name))
+            elif self._overflowing is True and len(queue) < self._max_size / 2:
+                self._overflowing = False
+            queue.appendleft((topic, data, retain))
+            self._count('queued')
+            self._condition.notify_all()
+
+    def _get(self, index):
+        with self._condition:
+            while True:
+                if index >= self._worker_count:
+                    return None
+                queue = self._queues[index]
+                if len(queue) > 0:
+                    return queue.pop()
+                self._condition.wait()
+
+    def _worker(self, index):
+        while True:
+            message = self._get(index)
+            if message is None:
+                return
+            try:
+                self._publish(*message)
+                self._count('published')
+            except Exception:
+                self._count('errors')
+
+    def _count(self, counter):
+        with self._stats_lock:
+            self._counters[counter] += 1
+            if counter == 'published':
+                now = time.time()
+                if now - self._rate_start >= 10:
+                    self._rate = (self._counters['published'] - self._rate_published) / (now - self._rate_start)
+                    self._rate_start = now
+                    self._rate_published = self._counters['published']
+
+    def get_stats(self):
+        with self._condition:
+            depth = sum(len(queue) for queue in self._queues)
+        with self._stats_lock:
+            stats = dict(self._counters)
+            stats.update({'depth': depth,
+                          'rate': round(self._rate, 2)})
+            return stats
+
+
+class Outbox(object):
+    """
+    Holds the messages with QoS 1 or 2 while the MQTT broker is unreachable. Once it's reachable again, they're
+    published at a limited rate, so a broker restart loses no state changes and doesn't cause a publish storm.
+    While the outbox isn't empty new messages are queued behind it, to keep them in order. QoS 0 messages have no
+    order to keep, so they're always published right away (or discarded while the broker is unreachable).
+    """
+
+    MAX_SPILL_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, publish, spill_path, logger):
+        self._publish = publish
+        self._spill_path = spill_path
+        self.logger = logger
+        self._lock = Lock()
+        self._event = Event()
+        self._messages = deque()
+        self._max_size = 1000
+        self._spill = False
+        self._rate = 20
+        self._spill_offset = 0
+        self._spill_size = os.path.getsize(spill_path) if os.path.exists(spill_path) else 0
+        self._counters = {'held': 0, 'replayed': 0, 'spilled': 0, 'dropped': 0, 'discarded': 0}
+        self._thread = Thread(target=self._drain)
+        self._thread.setName('MQTTClient outbox')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def configure(self, max_size, spill, rate):
+        with self._lock:
+            self._max_size = max(1, max_size)
+            self._spill = spill
+            self._rate = max(1, rate)
+
+    def __len__(self):
+        return len(self._messages) + (1 if self._spill_size > self._spill_offset else 0)
+
+    def resume(self):
+        self._event.set()
+
+    def publish(self, message):
+        """
+        Publishes a message right away when possible, or holds it
+        """
+        with self._lock:
+            if (message[3] == 0 or len(self) == 0) and self._publish(*message) is True:
+                return
+            if message[3] == 0:
+                self._counters['discarded'] += 1  # QoS 0 is at most once
+                return
+            self._hold(message)
+        self._event.set()
+
+    def _hold(self, message):
+        self._counters['held'] += 1
+        if self._spill_size > self._spill_offset or (len(self._messages) >= self._max_size and self._spill is True):
+            if self._spill_size < Outbox.MAX_SPILL_BYTES:
+                line = json.dumps(message) + '\n'
+                with open(self._spill_path, 'a') as spill_file:
+                    spill_file.write(line)
+                self._spill_size += len(line)
+                self._counters['spilled'] += 1
+            else:
+                self._counters['dropped'] += 1
+            return
+        if len(self._messages) >= self._max_size:
+            self._messages.pop()
+            self._counters['dropped'] += 1
+        self._messages.appendleft(message)
+
+    def _load_spill(self):
+        """
+        Moves a chunk of spilled messages back to memory. Must be called while holding the lock.
+        """
+        with open(self._spill_path, 'r') as spill_file:
+            spill_file.seek(self._spill_offset)
+            while len(self._messages) < self._max_size:
+                line = spill_file.readline()
+                if not line.endswith('\n'):
+                    break
+                self._spill_offset += len(line)
+                topic, data, retain, qos = json.loads(line)
+                self._messages.appendleft((topic.encode('utf-8'), data, retain, qos))
+        if self._spill_offset >= self._spill_size:
+            os.remove(self._spill_path)
+            self._spill_offset = 0
+            self._spill_size = 0
+
+    def _drain(self):
+        while True:
+            try:
+                # Woken when a message is held or the broker is reachable again. A timed wait polls on Python 2.
+                self._event.wait()
+                self._event.clear()
+                while True:
+                    start = time.time()
+                    with self._lock:
+                        if len(self._messages) == 0 and self._spill_size > self._spill_offset:
+                            self._load_spill()
+                        if len(self._messages) == 0:
+                            break
+                        if self._publish(*self._messages[-1]) is False:
+                            break
+                        self._messages.pop()
+                        self._counters['replayed'] += 1
+                    delay = 1.0 / self._rate - (time.time() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+            except Exception as ex:
+                self.logger('Error publishing from the outbox: {0}'.format(ex))
+                time.sleep(10)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({'depth': len(self._messages),
+                          'spill_bytes': self._spill_size - self._spill_offset})
+            return stats
+
+
+class Dispatcher(object):
+    """
+    Executes output commands on its own thread. Commands are collected for a short window, in which a newer
+    command for the same output replaces the pending one, so e.g. a dimmer slider doesn't flood the master.
+    """
+
+    def __init__(self, execute, logger):
+        self._execute = execute
+        self.logger = logger
+        self.window = 0.1
+        self._condition = Condition()
+        self._pending = OrderedDict()
+        self._counters = {'received': 0, 'coalesced': 0, 'executed': 0, 'errors': 0}
+        self._thread = Thread(target=self._worker)
+        self._thread.setName('MQTTClient command dispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, output_id, value):
+        with self._condition:
+            self._counters['received'] += 1
+            if output_id in self._pending:
+                self._counters['coalesced'] += 1
+            self._pending[output_id] = value
+            self._condition.notify()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+            # Give the rest of a burst (e.g. a scene) the time to come in
+            time.sleep(self.window)
+            with self._condition:
+                commands = self._pending.items()
+                self._pending.clear()
+            for output_id, value in commands:
+                try:
+                    self._execute(output_id, value)
+                    self._counters['executed'] += 1
+                except Exception as ex:
+                    self._counters['errors'] += 1
+                    self.logger('Error setting output {0}: {1}'.format(output_id, ex))
+
+    def get_stats(self):
+        with self._condition:
+            stats = dict(self._counters)
+            stats['pending'] = len(self._pending)
+            return stats
+
+
+class MetricPublisher(object):
+    """
+    Publishes metrics on topics formatted from their source, type and tags. Per metric type, a series can be
+    rate limited, and metrics can be batched into a single message per topic.
+    """
+
+    DEFAULT_TOPIC = 'openmotics/metrics/{source}/{type}'
+
+    class _Fields(dict):
+        def __missing__(self, key):
+            return ''
+
+    def __init__(self, send, logger):
+        self._send = send
+        self.logger = logger
+        self._rules = []
+        self._rule_cache = {}
+        self._last_published = {}
+        self._batches = {}
+        self._batch_interval = 10
+        self._lock = Lock()
+        self._batched = Event()
+        self._formatter = string.Formatter()
+        self._counters = {'received': 0, 'published': 0, 'rate_limited': 0, 'batches': 0}
+        self._thread = Thread(target=self._flusher)
+        self._thread.setName('MQTTClient metric batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def configure(self, rules, batch_interval):
+        with self._lock:
+            self._rules = [{'type': rule.get('type') or '*',
+                            'topic': (rule.get('topic') or MetricPublisher.DEFAULT_TOPIC).encode('utf-8'),
+                            'interval': max(0, rule.get('interval') or 0),
+                            'batch': rule.get('batch', False)}
+                           for rule in rules]
+            self._rule_cache = {}
+            self._last_published = {}
+            self._batch_interval = max(1, batch_interval)
+
+    def _get_rule(self, metric_type):
+        try:
+            return self._rule_cache[metric_type]
+        except KeyError:
+            rule = None
+            for candidate in self._rules:
+                if fnmatchcase(metric_type, candidate['type']):
+                    rule = candidate
+                    break
+            self._rule_cache[metric_type] = rule
+            return rule
+
+    def _get_topic(self, template, metric):
+        fields = MetricPublisher._Fields()
+        for key, value in metric['tags'].iteritems():
+            fields[key] = value
+        fields['source'] = metric['source']
+        fields['type'] = metric['type']
+        for key, value in fields.items():
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            # Wildcards aren't allowed in a topic, and a slash would add a level
+            fields[key] = str(value).replace('/', '_').replace('+', '_').replace('#', '_')
+        return self._formatter.vformat(template, (), fields)
+
+    def receive(self, metric):
+        rule = self._get_rule(metric['type'])
+        if rule is None:
+            return
+        with self._lock:
+            self._counters['received'] += 1
+            if rule['interval'] > 0:
+                series = (metric['type'], metric['source'], frozenset(metric['tags'].iteritems()))
+                timestamp = metric.get('timestamp') or time.time()
+                last_published = self._last_published.get(series)
+                if last_published is not None and timestamp - last_published < rule['interval']:
+                    self._counters['rate_limited'] += 1
+                    return
+                self._last_published[series] = timestamp
+        topic = self._get_topic(rule['topic'], metric)
+        if rule['batch'] is True:
+            with self._lock:
+                if len(self._batches) == 0:
+                    self._batched.set()
+                self._batches.setdefault(topic, []).append(metric)
+        else:
+            self._send(topic, metric, retain=False)
+            with self._lock:
+                self._counters['published'] += 1
+
+    def _flusher(self):
+        while True:
+            # A timed wait polls on Python 2, so only sleep while there's a batch to publish
+            self._batched.wait()
+            self._batched.clear()
+            time.sleep(self._batch_interval)
+            try:
+                with self._lock:
+                    batches, self._batches = self._batches, {}
+                for topic, metrics in batches.iteritems():
+                    self._send(topic, metrics, retain=False)
+                    with self._lock:
+                        self._counters['batches'] += 1
+                        self._counters['published'] += len(metrics)
+            except Exception as ex:
+                self.logger('Error publishing batched metrics: {0}'.format(ex))
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['batched'] = sum(len(metrics) for metrics in self._batches.itervalues())
+            return stats
+
+
+class LogChannel(object):
+    """
+    Buffers log messages and publishes them as one message every interval. Messages below the configured level
+    are discarded right away, and messages exceeding the rate are dropped (and counted in the next message).
+    """
+
+    LEVELS = {'off': 0, 'error': 1, 'info': 2}
+    TOPIC = 'openmotics/logging'
+
+    def __init__(self, send, logger):
+        self._send = send
+        self.logger = logger
+        self._level = LogChannel.LEVELS['info']
+        self._interval = 1
+        self._capacity = 20
+        self._buffer = []
+        self._dropped = 0  # Dropped since the last publish
+        self._lock = Lock()
+        self._buffered = Event()
+        self._counters = {'logged': 0, 'published': 0, 'batches': 0, 'filtered': 0, 'dropped': 0}
+        self._thread = Thread(target=self._flusher)
+        self._thread.setName('MQTTClient logging')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def configure(self, level, interval, rate):
+        with self._lock:
+            self._level = LogChannel.LEVELS.get(level, LogChannel.LEVELS['info'])
+            self._interval = max(1, interval)
+            self._capacity = max(1, rate) * self._interval
+            if self._level == LogChannel.LEVELS['off']:
+                self._buffer = []
+                self._dropped = 0
+
+    def log(self, message, level='info'):
+        with self._lock:
+            if LogChannel.LEVELS[level] > self._level:
+                self._counters['filtered'] += 1
+            elif len(self._buffer) >= self._capacity:
+                self._counters['dropped'] += 1
+                self._dropped += 1
+            else:
+                if len(self._buffer) == 0:
+                    self._buffered.set()
+                self._counters['logged'] += 1
+                self._buffer.append(message)
+
+    def _flusher(self):
+        while True:
+            # A timed wait polls on Python 2, so only sleep while there are messages to publish
+            self._buffered.wait()
+            self._buffered.clear()
+            time.sleep(self._interval)
+            try:
+                with self._lock:
+                    messages, self._buffer = self._buffer, []
+                    if self._dropped > 0:
+                        messages.append('{0} log messages dropped'.format(self._dropped))
+                        self._dropped = 0
+                if len(messages) == 0:
+                    continue
+                self._send(LogChannel.TOPIC, messages, retain=False)
+                with self._lock:
+                    self._counters['batches'] += 1
+                    self._counters['published'] += len(messages)
+            except Exception as ex:
+                self.logger('Error publishing log messages: {0}'.format(ex))
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['buffered'] = len(self._buffer)
+            return stats